@@ -18,6 +18,7 @@ setup(name='whichfoil',
       entry_points = {
           'console_scripts': [
               'whichfoil=whichfoil.main:main',
+              'whichfoil-batch=whichfoil.batch:main',
           ],
       },
       platforms = ['any'],
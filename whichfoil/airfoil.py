@@ -1,5 +1,12 @@
 # -*- coding: latin-1 -*-
 
+import re
+from array import array
+from itertools import compress
+from bisect import bisect_left
+
+
+nan = float('nan')
 
 class ParseError(Exception):
     pass
@@ -33,32 +40,16 @@ def descending(l):
     return True    
 
 
-def load_airfoil(f):
-    next = f.readline
-
-    l = next()
-    comments = []
-    values = []    
-    while True:
-        s = l.strip()
-        if s:
-            if is_coord(l): 
-                x, y = [float(s) for s in l.split()]
-                values.append((x, y))
-                break
-            else:
-                comments.append(s)
-        l = next()
-    
-    for l in f:
-        if not l.strip():
-            continue
-        if not is_coord(l):
-            continue # raise ParseError("Expected coordinate tuple: "+repr(l))
-        x, y = [float(s) for s in l.split()]
-        values.append((x, y))
-
-    px, py = values[0]
+def _convert(values):
+    # Converts the flat list of coordinate values [x0, y0, x1, y1,
+    # ...] into the arrays (xv, yv). Handles Selig's and Lednicer's
+    # format.
+    values = array('d', values)
+    xv = values[0::2]
+    yv = values[1::2]
+    if not xv:
+        raise ParseError("No coordinates found")
+    px, py = xv[0], yv[0]
     if px>1.5 or py > 1.5: # assume Letnicer's format
     
         # Lednicer's format lists points on the upper surface (from leading
@@ -66,11 +57,8 @@ def load_airfoil(f):
         # leading edge to trailing edge). 
 
         nupper, nlower = int(px), int(py)
-        upper = values[1:nupper+1]
-        lower = values[nupper+1:]
-        values = upper+lower
-        upper.reverse()
-        values = lower+upper
+        xv = xv[nupper+1:]+xv[nupper:0:-1]
+        yv = yv[nupper+1:]+yv[nupper:0:-1]
     else:
         # assume Selig's format
 
@@ -81,9 +69,100 @@ def load_airfoil(f):
         pass # nothing to do
 
     # remove values outside -0.001 ... 1.001
-    coordinates = [p for p in values if p[0]>-0.001 and p[0]<1.001]
-    xv, yv = zip(*coordinates)
-    return '\n'.join(comments), (xv, yv)
+    if xv and not (min(xv)>-0.001 and max(xv)<1.001):
+        keep = [x>-0.001 and x<1.001 for x in xv]
+        xv = array('d', compress(xv, keep))
+        yv = array('d', compress(yv, keep))
+    if not xv:
+        raise ParseError("No coordinates found")
+    return xv, yv
+
+
+def _parse_values(lines):
+    # Returns the flat list of coordinate values in *lines*. If every
+    # non-blank line has two values, all values are converted in one
+    # pass. Otherwise lines which are not coordinate tuples are
+    # skipped.
+    rows = [row for row in map(str.split, lines) if row]
+    if all(len(row) == 2 for row in rows):
+        try:
+            return [float(s) for row in rows for s in row]
+        except ValueError:
+            pass
+    values = []
+    for l in lines:
+        if is_coord(l):
+            values.extend(float(s) for s in l.split())
+    return values
+
+
+def _split_lines(s):
+    if '\r' in s:
+        return re.split('\r\n|\r|\n', s)
+    return s.split('\n')
+    
+
+def parse_airfoil(s):
+    """Parses the airfoil file contents *s*.
+
+    Returns a tuple (comments, (xv, yv)) with the coordinates as
+    arrays. The result is equal to that of load_airfoil.
+    """
+    lines = _split_lines(s)
+    comments = []
+    for i, l in enumerate(lines):
+        s = l.strip()
+        if not s:
+            continue
+        if is_coord(l):
+            break
+        comments.append(s)
+    else:
+        raise ParseError("No coordinates found")
+    return '\n'.join(comments), _convert(_parse_values(lines[i:]))
+
+
+def load_airfoil(f):
+    """Reads an airfoil from file *f*.
+
+    Returns a tuple (comments, (xv, yv)) with the coordinates as
+    tuples.
+    """
+    comments, (xv, yv) = parse_airfoil(f.read())
+    return comments, (tuple(xv), tuple(yv))
+
+
+_coord_re = re.compile(r'^\s*\S+\s+\S+\s*$')
+
+def iter_airfoils(f):
+    """Reads airfoils from file *f*, which can contain several
+    concatenated airfoils.
+
+    Yields a tuple (comments, (xv, yv)) for each airfoil. The file is
+    read line by line, so only one airfoil is held in memory. A
+    non-coordinate line following coordinates starts the next
+    airfoil. Trailing comments after the last airfoil are ignored.
+    """
+    comments = []
+    lines = []
+    found = False
+    for l in f:
+        s = l.strip()
+        if not s:
+            continue
+        if _coord_re.match(l) and is_coord(l):
+            lines.append(l)
+        else:
+            if lines:
+                yield '\n'.join(comments), _convert(_parse_values(lines))
+                found = True
+                comments = []
+                lines = []
+            comments.append(s)
+    if lines:
+        yield '\n'.join(comments), _convert(_parse_values(lines))
+    elif not found:
+        raise ParseError("No coordinates found")
     
 
 def _interpolate(x, x1, x2, y1, y2):
@@ -91,22 +170,204 @@ def _interpolate(x, x1, x2, y1, y2):
         raise ValueError(x, x1, x2)
     return y1+(y2-y1)/(x2-x1)*(x-x1) 
 
+class Airfoil:
+    """An airfoil contour prepared for fast interpolation.
+
+    The contour is split into runs in which x is monotone. For a
+    normal airfoil these are the upper and lower surface, split at the
+    leading edge. Each run is stored with ascending x, so that the
+    intersection with x=t is found by bisection.
+    """
+    def __init__(self, xv, yv):
+        self.xv = xv
+        self.yv = yv
+        self.surfaces = surfaces = []
+        n = len(xv)
+        start = 0
+        direction = 0
+        for k in range(1, n):
+            d = xv[k]-xv[k-1]
+            if d == 0: # vertical segments never intersect
+                continue
+            s = 1 if d > 0 else -1
+            if direction == 0:
+                direction = s
+            elif s != direction:
+                surfaces.append(self._mk_surface(start, k-1, direction))
+                start = k-1
+                direction = s
+        if direction != 0:
+            surfaces.append(self._mk_surface(start, n-1, direction))
+
+    def _mk_surface(self, i, j, direction):
+        xs = list(self.xv[i:j+1])
+        ys = list(self.yv[i:j+1])
+        if direction < 0:
+            xs.reverse()
+            ys.reverse()
+        return xs, ys
+
+    def values(self, t):
+        """Returns the list of y-values where the contour intersects
+        x=t, in the order of the contour."""
+        r = []
+        for xs, ys in self.surfaces:
+            # the segment covering t satisfies xs[i-1] < t <= xs[i],
+            # as in interpolate_airfoil
+            i = bisect_left(xs, t)
+            if 0 < i < len(xs):
+                x1 = xs[i-1]
+                y1 = ys[i-1]
+                r.append(y1+(ys[i]-y1)/(xs[i]-x1)*(t-x1))
+        return r
+
+    def surface(self, t):
+        """Returns the tuple (lower, upper) of y-values at x=t. If the
+        contour does not cover t, nan is returned for both."""
+        r = self.values(t)
+        if not r:
+            return nan, nan
+        return min(r), max(r)
+
+    def evaluate(self, tv):
+        """Returns the lists (lower, upper) of y-values at all x=t in
+        *tv*. If *tv* is ascending, each bisection starts at the
+        previous result."""
+        lower = [nan]*len(tv)
+        upper = [nan]*len(tv)
+        for xs, ys in self.surfaces:
+            n = len(xs)
+            i = last = 0
+            for k, t in enumerate(tv):
+                if t < last:
+                    i = 0
+                last = t
+                i = bisect_left(xs, t, i)
+                if 0 < i < n:
+                    x1 = xs[i-1]
+                    y1 = ys[i-1]
+                    y = y1+(ys[i]-y1)/(xs[i]-x1)*(t-x1)
+                    if not y >= lower[k]: # also true if lower[k] is nan
+                        lower[k] = y
+                    if not y <= upper[k]:
+                        upper[k] = y
+        return lower, upper
+
+
 def interpolate_airfoil(t, xv, yv):
     """Determines the intersection of the profile coordinates with x=t
 
-    Returns a tuple (upper, lower).
+    Returns a list of y-values. For repeated lookups on the same
+    airfoil use the class Airfoil.
     """
     if t<0 or t>1:
         raise ValueError(t)
+    return Airfoil(xv, yv).values(t)
+
+
+
+def _load_airfoil_reference(f):
+    # Line by line reference implementation for the tests
+    values = []
+    comments = []
+    for l in f:
+        if not l.strip():
+            continue
+        if values or is_coord(l):
+            if is_coord(l):
+                values.append([float(s) for s in l.split()])
+        else:
+            comments.append(l.strip())
+    if values[0][0]>1.5 or values[0][1]>1.5:
+        nupper = int(values[0][0])
+        upper = values[1:nupper+1]
+        lower = values[nupper+1:]
+        upper.reverse()
+        values = lower+upper
+    values = [p for p in values if p[0]>-0.001 and p[0]<1.001]
+    xv, yv = zip(*values)
+    return '\n'.join(comments), (xv, yv)
+
+
+def test_00():
+    "parse selig and lednicer"
+    import io, os
+    path = os.path.join(os.path.dirname(__file__), 'foils')
+    for name in ('a18-il.dat', '2032c-il.dat', 'joukowsk-il.dat'):
+        s = io.open(os.path.join(path, name), encoding='latin-1').read()
+        r1 = load_airfoil(io.StringIO(s))
+        r2 = _load_airfoil_reference(io.StringIO(s))
+        assert r1 == r2
+    
+    
+def test_01():
+    "streaming"
+    import io, os
+    path = os.path.join(os.path.dirname(__file__), 'foils')
+    names = ('a18-il.dat', '2032c-il.dat', 'clarky-il.dat')
+    l = []
+    for name in names:
+        l.append(io.open(os.path.join(path, name), encoding='latin-1').read())
+    foils = list(iter_airfoils(io.StringIO(''.join(l))))
+    assert len(foils) == 3
+    for s, (comments, (xv, yv)) in zip(l, foils):
+        assert load_airfoil(io.StringIO(s)) == (comments, (tuple(xv), tuple(yv)))
+
+
+def test_02():
+    "parse errors"
+    import io
+    for s in ('', 'comment\n', 'comment\n2.0 2.0\n'):
+        try:
+            load_airfoil(io.StringIO(s))
+        except ParseError:
+            pass
+        else:
+            assert False
+    # the fast path must not pair values across lines
+    s = 'hdr\n1.0 0.0\n0.5 0.1 7\n3\n0.0 0.0\n'
+    comments, (xv, yv) = parse_airfoil(s)
+    assert (tuple(xv), tuple(yv)) == ((1.0, 0.0), (0.0, 0.0))
+
+
+def _interpolate_reference(t, xv, yv):
+    # The original linear scan of interpolate_airfoil
     l = []
     ax = None
     for i, x in enumerate(xv):
         if ax is not None:
             if (ax<t and t<=x): 
-                ty = _interpolate(t, ax, x, yv[i-1], yv[i])
-                l.append(ty)        
+                l.append(_interpolate(t, ax, x, yv[i-1], yv[i]))
             elif (x<t and t<=ax): 
-                ty = _interpolate(t, x, ax, yv[i], yv[i-1])
-                l.append(ty)        
+                l.append(_interpolate(t, x, ax, yv[i], yv[i-1]))
         ax = x
     return l
+
+
+def test_03():
+    "interpolation"
+    import io, os
+    path = os.path.join(os.path.dirname(__file__), 'foils')
+    names = sorted(os.listdir(path))
+    names = [name for name in names if name.endswith('.dat')][::10]
+    tv = [j/100.0 for j in range(101)]+[0.0005, 0.3333, 0.999]
+    for name in names:
+        f = io.open(os.path.join(path, name), encoding='latin-1')
+        comments, (xv, yv) = load_airfoil(f)
+        foil = Airfoil(xv, yv)
+        lower, upper = foil.evaluate(tv)
+        for k, t in enumerate(tv):
+            l = _interpolate_reference(t, xv, yv)
+            assert interpolate_airfoil(t, xv, yv) == l
+            if l:
+                assert (lower[k], upper[k]) == (min(l), max(l))
+                assert foil.surface(t) == (min(l), max(l))
+            else:
+                assert lower[k] != lower[k]
+    # contour with a loop
+    xv = (1.0, 0.5, 0.0, 0.6, 0.4, 1.0)
+    yv = (0.0, 0.1, 0.0, -0.1, -0.2, 0.0)
+    foil = Airfoil(xv, yv)
+    assert len(foil.surfaces) == 4
+    for t in (0.1, 0.45, 0.5, 0.55, 0.9):
+        assert foil.values(t) == _interpolate_reference(t, xv, yv)
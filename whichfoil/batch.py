@@ -0,0 +1,206 @@
+# -*- coding: latin-1 -*-
+
+"""
+Headless identification of saved analyses.
+
+Usage: whichfoil-batch [options] file.wfd ...
+
+Each document is loaded without any GUI and matched against the
+airfoil catalog, either by its sliders or by its traced outline. One
+JSON object per document is written per line, as soon as it is
+available:
+
+    {"file": ..., "names": [...], "scores": [...], "time": ...}
+
+Documents which can not be processed give {"file": ..., "error": ...}.
+The documents are distributed over a pool of worker processes. Each
+worker opens the catalog once and keeps its match engines.
+"""
+
+import sys
+import json
+import time
+import argparse
+import multiprocessing
+
+from .document import load_model
+from .catalog import open_catalog
+from .matching import MatchEngine, OutlineMatcher
+from .fitting import params_from_points, image2profile
+
+
+# Per process state, set up by _init_worker
+_catalog = None
+_engines = {}
+_outline_matcher = None
+_options = None
+
+
+def _init_worker(options):
+    # Pool workers are daemonic and can not start processes of their
+    # own. The cache has been updated by run, so they only read it.
+    global _catalog, _options
+    _catalog = open_catalog(processes=1)
+    _options = options
+
+
+def _get_engine(stations):
+    stations = tuple(stations)
+    engine = _engines.get(stations)
+    if engine is None:
+        engine = _engines[stations] = MatchEngine(_catalog, stations)
+    return engine
+
+
+def _get_outline_matcher():
+    global _outline_matcher
+    if _outline_matcher is None:
+        _outline_matcher = OutlineMatcher(_catalog)
+    return _outline_matcher
+
+
+def identify(model, k=10, outline=False):
+    """Returns the *k* airfoils best matching the document *model* as
+    a list of tuples (name, score). If *outline* is true and the
+    document has a traced outline, the outline is matched instead of
+    the sliders."""
+    if outline and model.outline:
+        params = params_from_points(model.p1, model.p2, model.yfactor)
+        points = image2profile(params, model.outline)
+        return _get_outline_matcher().rank(points, k)
+    sliders = model.sliders
+    sliders = list(zip(sliders[0::2], sliders[1::2]))
+    return _get_engine(model.stations).rank(sliders, k)
+
+
+def process_file(filename):
+    # Returns the result record of document *filename*
+    t = time.time()
+    try:
+        model = load_model(filename)
+        r = identify(model, _options['k'], _options['outline'])
+    except Exception as e:
+        return dict(file=filename, error=str(e) or e.__class__.__name__)
+    return dict(
+        file=filename,
+        names=[name for (name, score) in r],
+        scores=[score for (name, score) in r],
+        time=time.time()-t)
+
+
+def run(filenames, output, k=10, outline=False, processes=None):
+    """Processes all *filenames* and writes the results as JSON lines
+    to *output*. Results are written in the order of completion."""
+    options = dict(k=k, outline=outline)
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if processes > 1 and len(filenames) > 1:
+        # build or update the cache before the workers open it
+        open_catalog(processes=processes).close()
+        pool = multiprocessing.Pool(processes, _init_worker, (options, ))
+        try:
+            for r in pool.imap_unordered(process_file, filenames):
+                _write(output, r)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        _init_worker(options)
+        for filename in filenames:
+            _write(output, process_file(filename))
+
+
+def _write(output, r):
+    # JSON wants finite numbers
+    if 'scores' in r:
+        r['scores'] = [score if score == score else None for score in r['scores']]
+    output.write(json.dumps(r)+'\n')
+    output.flush()
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        prog='whichfoil-batch',
+        description="Identify the airfoils of saved analyses (.wfd files).")
+    parser.add_argument('files', nargs='+', metavar='FILE')
+    parser.add_argument('-k', '--top', type=int, default=10,
+                        help="number of airfoils reported per file")
+    parser.add_argument('-j', '--processes', type=int, default=None,
+                        help="number of worker processes")
+    parser.add_argument('--outline', action='store_true',
+                        help="match the traced outline if there is one")
+    parser.add_argument('-o', '--output', default=None,
+                        help="output file (default: stdout)")
+    options = parser.parse_args(args)
+    if options.output is None:
+        output = sys.stdout
+    else:
+        output = open(options.output, 'w')
+    try:
+        run(options.files, output, options.top, options.outline,
+            options.processes)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+
+def test_00():
+    "batch"
+    import os, io, tempfile, shutil
+    from .document import AnalysisModel
+    tmp = tempfile.mkdtemp()
+    try:
+        model = AnalysisModel()
+        model.sliders = (0.0885, -0.0361, 0.0940, -0.0351, 0.0513, -0.0224)
+        names = []
+        for i in range(3):
+            name = os.path.join(tmp, 'doc%i.wfd' % i)
+            model.save_as(name)
+            names.append(name)
+        bad = os.path.join(tmp, 'bad.wfd')
+        open(bad, 'w').write('garbage')
+        output = io.StringIO()
+        run(names+[bad], output, k=5, processes=2)
+        lines = [json.loads(l) for l in output.getvalue().splitlines()]
+        assert len(lines) == 4
+        results = dict((r['file'], r) for r in lines)
+        assert 'error' in results[bad]
+        r = results[names[0]]
+        assert len(r['names']) == 5
+        assert r['names'] == results[names[2]]['names']
+        assert r['scores'] == sorted(r['scores'])
+    finally:
+        shutil.rmtree(tmp)
+
+
+def test_01():
+    "batch with an empty cache"
+    import os, io, tempfile, shutil
+    from .document import AnalysisModel
+    tmp = tempfile.mkdtemp()
+    old = os.environ.get('WHICHFOIL_CACHE')
+    try:
+        os.environ['WHICHFOIL_CACHE'] = os.path.join(tmp, 'cache')
+        model = AnalysisModel()
+        model.sliders = (0.0885, -0.0361, 0.0940, -0.0351, 0.0513, -0.0224)
+        names = []
+        for i in range(2):
+            name = os.path.join(tmp, 'doc%i.wfd' % i)
+            model.save_as(name)
+            names.append(name)
+        output = io.StringIO()
+        run(names, output, k=3, processes=2)
+        lines = [json.loads(l) for l in output.getvalue().splitlines()]
+        assert len(lines) == 2
+        for r in lines:
+            assert len(r['names']) == 3
+    finally:
+        if old is None:
+            del os.environ['WHICHFOIL_CACHE']
+        else:
+            os.environ['WHICHFOIL_CACHE'] = old
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
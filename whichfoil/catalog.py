@@ -0,0 +1,901 @@
+# -*- coding: latin-1 -*-
+
+"""
+Persistent cache for airfoil catalogs.
+
+Parsing all .dat files of a catalog directory is slow. The parsed
+coordinates are therefore stored in a single cache file per
+directory. The file starts with a small header, followed by a json
+index and the coordinates as packed doubles:
+
+    magic | version | index length | index (json) | data
+
+Each index entry holds the name, size, mtime and hash of the source
+file, the header comments, the geometric properties (see shape.py),
+the number of points and the offset of its coordinates in the data
+section.
+
+After the coordinates, the data section holds the surface table for
+the matcher (see matching.surface_table): for each table sample one
+row with the lower surface values of all airfoils, followed by one
+row with the upper surface values. The matcher only needs to read
+the rows next to its stations. The cache is updated whenever a
+source file was added, removed or changed; only those files are
+parsed again. Cache files are written to a temporary file first and
+then renamed, so that several processes can build the same cache at
+the same time.
+"""
+
+import io
+import os
+import sys
+import json
+import struct
+import hashlib
+import atexit
+import shutil
+import tempfile
+import multiprocessing
+from array import array
+from collections import OrderedDict
+
+from .airfoil import load_airfoil, parse_airfoil
+from .matching import surface_table, TABLE_SAMPLES, nan
+from .shape import geometric_properties, PROPERTIES
+from . import foils
+
+
+CACHE_VERSION = 4
+_magic = b'WFCACHE\0'
+_header = struct.Struct('<8sII') # magic, version, length of index
+_itemsize = array('d').itemsize
+_min_parallel = 50 # smaller directories are parsed serially
+
+
+def get_cache_dir():
+    """Returns the directory where cache files are stored.
+
+    The location can be set with the environment variable
+    WHICHFOIL_CACHE.
+    """
+    path = os.environ.get('WHICHFOIL_CACHE')
+    if path:
+        return path
+    base = os.environ.get('XDG_CACHE_HOME') or \
+           os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'whichfoil')
+
+
+_fallback_dir = None
+def get_fallback_dir():
+    """Returns a temporary directory for cache files, which is used if
+    the cache directory can not be written. It is removed at exit."""
+    global _fallback_dir
+    if _fallback_dir is None:
+        _fallback_dir = tempfile.mkdtemp(prefix='whichfoil-')
+        atexit.register(shutil.rmtree, _fallback_dir, True)
+    return _fallback_dir
+
+
+def get_foils_dir():
+    """Returns the directory of the bundled airfoils"""
+    return os.path.dirname(os.path.abspath(foils.__file__))
+
+
+def get_cache_path(directory):
+    """Returns the name of the cache file for *directory*"""
+    key = hashlib.sha1(os.path.abspath(directory).encode('utf-8'))
+    return os.path.join(get_cache_dir(), 'foils-%s.cache' % key.hexdigest()[:16])
+
+
+def scan_directory(directory):
+    """Returns a sorted list of tuples (name, size, mtime) of all .dat
+    files in *directory*."""
+    r = []
+    for name in os.listdir(directory):
+        if not name.lower().endswith('.dat'):
+            continue
+        st = os.stat(os.path.join(directory, name))
+        r.append((name, st.st_size, st.st_mtime))
+    r.sort()
+    return r
+
+
+def file_hash(data):
+    return hashlib.sha1(data).hexdigest()
+
+
+def _read_hash(path):
+    # Returns the hash of file *path* or None if it can not be read
+    try:
+        with open(path, 'rb') as f:
+            return file_hash(f.read())
+    except (IOError, OSError):
+        return None
+
+
+class CacheWriteError(IOError):
+    """Raised if a cache file can not be written"""
+
+
+def parse_file(path):
+    """Parses the airfoil file *path*.
+
+    Returns a tuple (hash, comments, xv, yv).
+    """
+    data = open(path, 'rb').read()
+    comments, (xv, yv) = parse_airfoil(data.decode('latin-1'))
+    return file_hash(data), comments, xv, yv
+
+
+def write_cache(filename, directory, entries):
+    """Writes a cache file.
+
+    *entries* is a list of dicts with keys name, size, mtime, hash,
+    comments, xv, yv, lower and upper.
+    """
+    index = []
+    data = array('d')
+    for entry in entries:
+        xv = entry['xv']
+        yv = entry['yv']
+        d = dict((k, v) for (k, v) in entry.items() \
+                 if k not in ('xv', 'yv', 'lower', 'upper'))
+        d['offset'] = len(data)
+        d['count'] = len(xv)
+        data.extend(xv)
+        data.extend(yv)
+        index.append(d)
+    table = len(data)
+    for j in range(TABLE_SAMPLES+1):
+        for key in ('lower', 'upper'):
+            data.extend(entry[key][j] for entry in entries)
+    state = dict(directory=os.path.abspath(directory),
+                 byteorder=sys.byteorder, entries=index,
+                 table=table, samples=TABLE_SAMPLES)
+    s = json.dumps(state).encode('utf-8')
+
+    path = os.path.dirname(filename)
+    if not os.path.exists(path):
+        try:
+            os.makedirs(path)
+        except OSError: # created by a concurrent process
+            pass
+    try:
+        fd, tmpname = tempfile.mkstemp(dir=path, prefix='.tmp-')
+    except (IOError, OSError) as e:
+        raise CacheWriteError(str(e))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(_header.pack(_magic, CACHE_VERSION, len(s)))
+            f.write(s)
+            data.tofile(f)
+        os.replace(tmpname, filename)
+    except (IOError, OSError) as e:
+        os.remove(tmpname)
+        raise CacheWriteError(str(e))
+    except:
+        os.remove(tmpname)
+        raise
+
+
+def read_index(filename):
+    """Reads the index of a cache file.
+
+    Returns a tuple (index, offset) where offset is the position of
+    the data section in the file. Returns None if the file does not
+    exist or is not a valid cache file.
+    """
+    try:
+        f = open(filename, 'rb')
+    except (IOError, OSError):
+        return None
+    with f:
+        return _read_index(f)
+
+
+def _read_index(f):
+    s = f.read(_header.size)
+    if len(s) != _header.size:
+        return None
+    magic, version, n = _header.unpack(s)
+    if magic != _magic or version != CACHE_VERSION:
+        return None
+    try:
+        index = json.loads(f.read(n).decode('utf-8'))
+    except ValueError:
+        return None
+    if index.get('byteorder') != sys.byteorder or \
+       index.get('samples') != TABLE_SAMPLES:
+        return None
+    return index, _header.size+n
+
+
+def _read_coordinates(f, offset, entry):
+    # Reads the coordinates of a cache entry from the open file *f*
+    n = entry['count']
+    f.seek(offset+entry['offset']*_itemsize)
+    data = array('d')
+    data.fromfile(f, 2*n)
+    return data[:n], data[n:]
+
+
+def _read_table_rows(f, offset, index, j):
+    # Reads the rows (lower, upper) of table sample *j*
+    n = len(index['entries'])
+    f.seek(offset+(index['table']+2*j*n)*_itemsize)
+    data = array('d')
+    data.fromfile(f, 2*n)
+    return data[:n], data[n:]
+
+
+def is_uptodate(index, directory, stats=None):
+    """Checks if the cache index *index* matches the files in
+    *directory*.
+
+    Files whose size or mtime differ are compared by their hash.
+    """
+    if stats is None:
+        stats = scan_directory(directory)
+    entries = index['entries']
+    if len(entries) != len(stats):
+        return False
+    for entry, (name, size, mtime) in zip(entries, stats):
+        if entry['name'] != name:
+            return False
+        if entry['size'] == size and entry['mtime'] == mtime:
+            continue
+        hash = _read_hash(os.path.join(directory, name))
+        if hash is None or hash != entry['hash']:
+            return False
+    return True
+
+
+def _parse_entry(path):
+    # Worker function for build_cache. Exceptions are returned
+    # instead of raised, so that one broken file does not stop the
+    # build. The hash is None if the file can not be read at all.
+    try:
+        hash, comments, xv, yv = parse_file(path)
+    except Exception as e:
+        return _read_hash(path), '%s: %s' % (e.__class__.__name__, e)
+    lower, upper = surface_table(xv, yv)
+    properties = geometric_properties(xv, yv, (lower, upper))
+    return hash, comments, xv, yv, lower, upper, properties
+
+
+def parse_files(paths, processes=None):
+    """Parses the airfoil files *paths*.
+
+    Returns a list with a tuple (hash, comments, xv, yv, lower,
+    upper, properties) for each file, or a tuple (hash, error message)
+    if the file could not be parsed. The hash is None if the file
+    could not be read. The files are distributed over a pool of *processes*
+    worker processes. The default is to use all cores. The result
+    does not depend on the number of processes.
+
+    Daemonic processes, e.g. workers of another pool, can not have
+    children. There the files are always parsed serially.
+    """
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if multiprocessing.current_process().daemon:
+        processes = 1
+    if processes > 1 and len(paths) > _min_parallel:
+        try:
+            pool = multiprocessing.Pool(processes)
+        except (OSError, ImportError): # no process support
+            pool = None
+        if pool is not None:
+            try:
+                chunksize = max(1, len(paths)//(4*processes))
+                return pool.map(_parse_entry, paths, chunksize)
+            finally:
+                pool.close()
+                pool.join()
+    return [_parse_entry(path) for path in paths]
+
+
+def _mk_entry(name, size, mtime, r):
+    # Creates a cache entry from the result of _parse_entry
+    entry = dict(name=name, size=size, mtime=mtime, hash=r[0])
+    if len(r) == 2:
+        missing = [nan]*(TABLE_SAMPLES+1)
+        entry.update(error=r[1], comments='', xv=(), yv=(),
+                     lower=missing, upper=missing)
+    else:
+        hash, comments, xv, yv, lower, upper, properties = r
+        entry.update(comments=comments, xv=xv, yv=yv,
+                     lower=lower, upper=upper, properties=properties)
+    return entry
+
+
+def build_cache(directory, filename=None, processes=None):
+    """Parses all airfoils in *directory* and writes the cache file.
+
+    Files which can not be parsed are recorded in the index with
+    their error message.
+    """
+    if filename is None:
+        filename = get_cache_path(directory)
+    stats = scan_directory(directory)
+    paths = [os.path.join(directory, name) for (name, size, mtime) in stats]
+    entries = []
+    for (name, size, mtime), r in zip(stats, parse_files(paths, processes)):
+        entries.append(_mk_entry(name, size, mtime, r))
+    write_cache(filename, directory, entries)
+    return filename
+
+
+def update_cache(directory, filename=None, processes=None):
+    """Makes sure that an up to date cache file exists for
+    *directory*. Returns a tuple (index, offset) as read_index.
+
+    The cache is updated incrementally: only files which were added
+    or changed are parsed. The coordinates of all other files are
+    copied from the existing cache.
+    """
+    if filename is None:
+        filename = get_cache_path(directory)
+    try:
+        f = open(filename, 'rb')
+    except (IOError, OSError):
+        f = None
+    r = f and _read_index(f)
+    if r is None:
+        if f is not None:
+            f.close()
+        build_cache(directory, filename, processes)
+        return read_index(filename)
+    with f:
+        index, offset = r
+        old = dict((entry['name'], entry) for entry in index['entries'])
+        stats = scan_directory(directory)
+        modified = len(old) != len(stats)
+        keep = {}
+        parse = []
+        for name, size, mtime in stats:
+            entry = old.get(name)
+            if entry is not None:
+                if entry['size'] == size and entry['mtime'] == mtime:
+                    keep[name] = entry
+                    continue
+                modified = True
+                hash = _read_hash(os.path.join(directory, name))
+                if hash is not None and hash == entry['hash']: # touched only
+                    keep[name] = dict(entry, size=size, mtime=mtime)
+                    continue
+            else:
+                modified = True
+            parse.append((name, size, mtime))
+        if not modified:
+            return r
+
+        paths = [os.path.join(directory, name) for (name, size, mtime) in parse]
+        parsed = {}
+        for (name, size, mtime), r in zip(parse, parse_files(paths, processes)):
+            parsed[name] = _mk_entry(name, size, mtime, r)
+        rows = [_read_table_rows(f, offset, index, j) \
+                for j in range(TABLE_SAMPLES+1)]
+        rownumbers = dict((entry['name'], i) for (i, entry) \
+                          in enumerate(index['entries']))
+        entries = []
+        for name, size, mtime in stats:
+            entry = keep.get(name)
+            if entry is None:
+                entry = parsed[name]
+            else:
+                entry = dict(entry)
+                entry['xv'], entry['yv'] = _read_coordinates(f, offset, entry)
+                i = rownumbers[name]
+                entry['lower'] = [lower[i] for (lower, upper) in rows]
+                entry['upper'] = [upper[i] for (lower, upper) in rows]
+            entries.append(entry)
+    write_cache(filename, directory, entries)
+    return read_index(filename)
+
+
+_directories = []
+
+def register_directory(directory):
+    """Adds *directory* to the list of catalog directories"""
+    directory = os.path.abspath(directory)
+    if not directory in _directories:
+        _directories.append(directory)
+
+
+def get_directories():
+    """Returns the list of catalog directories.
+
+    These are the bundled airfoils, the directories listed in the
+    environment variable WHICHFOIL_PATH and the directories added by
+    register_directory. Directories which do not exist are skipped.
+    """
+    r = [get_foils_dir()]
+    l = os.environ.get('WHICHFOIL_PATH', '').split(os.pathsep)
+    for directory in l+_directories:
+        if not directory or not os.path.isdir(directory):
+            continue
+        directory = os.path.abspath(directory)
+        if not directory in r:
+            r.append(directory)
+    return r
+
+
+class _Source:
+    # A catalog directory and its cache file
+    def __init__(self, directory, filename):
+        self.directory = directory
+        self.filename = filename
+        self.file = None
+        self.entries = ()
+        self.offset = None
+
+    def update(self, processes=None):
+        try:
+            update_cache(self.directory, self.filename, processes)
+        except CacheWriteError:
+            # The cache directory is not writable. The cache is then
+            # built in a temporary directory for this session.
+            self.filename = os.path.join(get_fallback_dir(),
+                                         os.path.basename(self.filename))
+            update_cache(self.directory, self.filename, processes)
+        self.close()
+        # Keep the file open. If the cache is replaced by another
+        # process we still read the data matching our index.
+        f = self.file = open(self.filename, 'rb')
+        self.index, self.offset = _read_index(f)
+        self.entries = self.index['entries']
+        for i, entry in enumerate(self.entries):
+            entry['row'] = i
+
+    def read(self, entry):
+        xv, yv = _read_coordinates(self.file, self.offset, entry)
+        return tuple(xv), tuple(yv)
+
+    def read_table(self, j):
+        return _read_table_rows(self.file, self.offset, self.index, j)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class Catalog:
+    """A catalog of airfoils backed by cache files.
+
+    Only the index (names, comments and number of points) is held in
+    memory. Coordinates are read on demand and the most recently used
+    ones are kept in a bounded LRU. Files which could not be parsed
+    are listed in *errors*.
+
+    Airfoils from directories added later replace airfoils of the
+    same name from earlier directories. The attribute *version* is
+    incremented whenever the set of airfoils changes.
+    """
+    version = 0
+    def __init__(self, maxsize=256, processes=None):
+        self._sources = []
+        self._entries = {} # name -> (source, entry)
+        self._names = []
+        self._lru = OrderedDict()
+        self.errors = {}
+        self.maxsize = maxsize
+        self.processes = processes
+
+    def add_directory(self, directory, filename=None):
+        """Adds the airfoils in *directory*. The cache is used and
+        updated if necessary."""
+        if filename is None:
+            filename = get_cache_path(directory)
+        source = _Source(directory, filename)
+        source.update(self.processes)
+        self._sources.append(source)
+        self._update_entries()
+        self.version += 1
+
+    def rescan(self):
+        """Rescans all directories. Only new and modified files are
+        parsed. Returns the set of names which were added, changed or
+        removed."""
+        old = dict((name, entry['hash']) for (name, (source, entry)) \
+                   in self._entries.items())
+        for source in self._sources:
+            source.update(self.processes)
+        self._update_entries()
+        new = dict((name, entry['hash']) for (name, (source, entry)) \
+                   in self._entries.items())
+        changed = set()
+        for name in set(old.keys()) | set(new.keys()):
+            if old.get(name) != new.get(name):
+                changed.add(name)
+                self._lru.pop(name, None)
+        if changed:
+            self.version += 1
+        return changed
+
+    def _update_entries(self):
+        entries = {}
+        errors = {}
+        for source in self._sources:
+            for entry in source.entries:
+                name = entry['name']
+                if 'error' in entry:
+                    errors[name] = entry['error']
+                    entries.pop(name, None)
+                else:
+                    entries[name] = source, entry
+                    errors.pop(name, None)
+        self._entries = entries
+        self._names = sorted(entries.keys())
+        self.errors = errors
+
+    _fingerprint = None
+    def fingerprint(self):
+        """Returns a string identifying the names and contents of all
+        airfoils. Unlike *version* it is stable across sessions."""
+        if self._fingerprint is None or self._fingerprint[0] != self.version:
+            h = hashlib.sha1()
+            for name in self._names:
+                h.update(name.encode('utf-8'))
+                h.update(self._entries[name][1]['hash'].encode('ascii'))
+            self._fingerprint = self.version, h.hexdigest()
+        return self._fingerprint[1]
+
+    def __len__(self):
+        return len(self._names)
+
+    def __iter__(self):
+        return iter(self._names)
+
+    def __contains__(self, name):
+        return name in self._entries
+
+    def keys(self):
+        return list(self._names)
+
+    def get_info(self, name):
+        """Returns the index entry of airfoil *name*"""
+        return self._entries[name][1]
+
+    def get_comments(self, name):
+        return self._entries[name][1]['comments']
+
+    def read_table(self, j):
+        """Returns the arrays (lower, upper) with the surface values of
+        all airfoils at table sample *j*, in the order of keys()."""
+        rows = {}
+        for source in self._sources:
+            rows[source] = source.read_table(j)
+        lower = array('d')
+        upper = array('d')
+        for name in self._names:
+            source, entry = self._entries[name]
+            a, b = rows[source]
+            lower.append(a[entry['row']])
+            upper.append(b[entry['row']])
+        return lower, upper
+
+    def read_properties(self):
+        """Returns the geometric properties of all airfoils as dict
+        {property : array}, in the order of keys()."""
+        columns = dict((key, array('d')) for key in PROPERTIES)
+        for name in self._names:
+            properties = self._entries[name][1]['properties']
+            for key in PROPERTIES:
+                columns[key].append(properties[key])
+        return columns
+
+    def __getitem__(self, name):
+        lru = self._lru
+        try:
+            foil = lru.pop(name)
+        except KeyError:
+            foil = self.read(name)
+            if len(lru) >= self.maxsize:
+                lru.popitem(last=False)
+        lru[name] = foil
+        return foil
+
+    def get(self, name, default=None):
+        if name not in self._entries:
+            return default
+        return self[name]
+
+    def read(self, name):
+        """Reads the coordinates of airfoil *name* from the cache
+        file. Returns a tuple (xv, yv)."""
+        source, entry = self._entries[name]
+        return source.read(entry)
+
+    def items(self):
+        """Iterates over all airfoils. Yields tuples (name, (xv,
+        yv)). The LRU is not affected."""
+        for name in self._names:
+            foil = self._lru.get(name)
+            if foil is None:
+                foil = self.read(name)
+            yield name, foil
+
+    def close(self):
+        for source in self._sources:
+            source.close()
+
+
+def open_catalog(directories=None, maxsize=256, processes=None):
+    """Returns a catalog of all airfoils in *directories*. The default
+    is to use the directories returned by get_directories()."""
+    if directories is None:
+        directories = get_directories()
+    catalog = Catalog(maxsize, processes)
+    for directory in directories:
+        catalog.add_directory(directory)
+    return catalog
+
+
+
+def _mk_testdir(names=('a18-il.dat', 'a18sm-il.dat', 'clarky-il.dat')):
+    import shutil
+    tmp = tempfile.mkdtemp()
+    src = get_foils_dir()
+    for name in names:
+        shutil.copy(os.path.join(src, name), tmp)
+    return tmp
+
+
+def test_00():
+    "build / read cache"
+    import shutil
+    tmp = _mk_testdir()
+    try:
+        cachefile = os.path.join(tmp, 'cache', 'test.cache')
+        catalog = Catalog()
+        catalog.add_directory(tmp, cachefile)
+        assert catalog.keys() == ['a18-il.dat', 'a18sm-il.dat', 'clarky-il.dat']
+        for name, foil in catalog.items():
+            f = io.open(os.path.join(tmp, name), encoding='latin-1')
+            comments, foil2 = load_airfoil(f)
+            assert foil == foil2
+            assert catalog[name] == foil2
+            assert catalog.get_comments(name) == comments
+        assert catalog.get_comments('a18-il.dat') == 'A18 (original)'
+        for j in (0, 50, TABLE_SAMPLES):
+            lower, upper = catalog.read_table(j)
+            for i, name in enumerate(catalog):
+                a, b = surface_table(*catalog[name])
+                assert repr((lower[i], upper[i])) == repr((a[j], b[j]))
+        catalog.close()
+    finally:
+        shutil.rmtree(tmp)
+
+
+def test_01():
+    "rebuild on changes"
+    import shutil
+    tmp = _mk_testdir()
+    try:
+        cachefile = os.path.join(tmp, 'cache', 'test.cache')
+        index, offset = update_cache(tmp, cachefile)
+        assert is_uptodate(index, tmp)
+
+        # touching a file does not invalidate the cache
+        path = os.path.join(tmp, 'clarky-il.dat')
+        os.utime(path, (0, 0))
+        assert is_uptodate(index, tmp)
+
+        # modifying does
+        open(path, 'a').write('\n')
+        assert not is_uptodate(index, tmp)
+        index, offset = update_cache(tmp, cachefile)
+        assert is_uptodate(index, tmp)
+
+        # removing does
+        os.remove(path)
+        assert not is_uptodate(index, tmp)
+        catalog = Catalog()
+        catalog.add_directory(tmp, cachefile)
+        assert catalog.keys() == ['a18-il.dat', 'a18sm-il.dat']
+        catalog.close()
+    finally:
+        shutil.rmtree(tmp)
+
+
+def test_02():
+    "lru"
+    import shutil
+    tmp = _mk_testdir()
+    try:
+        cachefile = os.path.join(tmp, 'cache', 'test.cache')
+        catalog = Catalog(maxsize=2)
+        catalog.add_directory(tmp, cachefile)
+        for name in catalog:
+            catalog[name]
+        assert list(catalog._lru.keys()) == ['a18sm-il.dat', 'clarky-il.dat']
+        catalog['a18sm-il.dat']
+        assert list(catalog._lru.keys()) == ['clarky-il.dat', 'a18sm-il.dat']
+        assert 'a18-il.dat' in catalog
+        assert catalog.get('xxx') is None
+        catalog.close()
+    finally:
+        shutil.rmtree(tmp)
+
+
+def test_03():
+    "parallel parsing"
+    import shutil
+    names = sorted(os.listdir(get_foils_dir()))
+    names = [name for name in names if name.endswith('.dat')][:200]
+    tmp = _mk_testdir(names)
+    try:
+        open(os.path.join(tmp, 'broken.dat'), 'w').write('no coordinates\n')
+        paths = [os.path.join(tmp, name) for name in names+['broken.dat']]
+        r1 = parse_files(paths, processes=1)
+        r2 = parse_files(paths, processes=4)
+        assert repr(r1) == repr(r2) # repr, as nan != nan
+        assert len(r1[-1]) == 2 # error
+        # inside a pool worker
+        pool = multiprocessing.Pool(1)
+        try:
+            r3 = pool.apply(parse_files, (paths, 4))
+        finally:
+            pool.close()
+            pool.join()
+        assert repr(r1) == repr(r3)
+
+        cachefile = os.path.join(tmp, 'cache', 'test.cache')
+        catalog = Catalog(processes=4)
+        catalog.add_directory(tmp, cachefile)
+        assert list(catalog.errors.keys()) == ['broken.dat']
+        assert catalog.keys() == names
+        catalog.close()
+    finally:
+        shutil.rmtree(tmp)
+
+
+def test_04():
+    "incremental update"
+    import shutil
+    tmp = _mk_testdir()
+    tmp2 = _mk_testdir(('clarky-il.dat', 'ag03-il.dat'))
+    try:
+        cachefile = os.path.join(tmp, 'cache', 'test.cache')
+        cachefile2 = os.path.join(tmp, 'cache', 'test2.cache')
+        catalog = Catalog()
+        catalog.add_directory(tmp, cachefile)
+        catalog.add_directory(tmp2, cachefile2)
+        assert catalog.keys() == ['a18-il.dat', 'a18sm-il.dat', 'ag03-il.dat',
+                                  'clarky-il.dat']
+        assert catalog.get_info('clarky-il.dat') is catalog._sources[1].entries[1]
+        foil = catalog['a18-il.dat']
+        assert catalog.rescan() == set()
+
+        # only the new file is parsed
+        shutil.copy(os.path.join(get_foils_dir(), 'ag04-il.dat'), tmp)
+        path = os.path.join(tmp, 'a18sm-il.dat')
+        f = io.open(path, encoding='latin-1')
+        comments, (xv, yv) = load_airfoil(f)
+        open(path, 'w').write('modified\n1.0 0.0\n0.0 0.0\n1.0 0.0\n')
+        os.remove(os.path.join(tmp2, 'ag03-il.dat'))
+        parsed = []
+        global parse_files
+        _parse_files = parse_files
+        def parse_files(paths, processes=None):
+            parsed.extend(os.path.basename(p) for p in paths)
+            return _parse_files(paths, processes)
+        try:
+            changed = catalog.rescan()
+        finally:
+            parse_files = _parse_files
+        assert sorted(parsed) == ['a18sm-il.dat', 'ag04-il.dat']
+        assert changed == set(['a18sm-il.dat', 'ag04-il.dat', 'ag03-il.dat'])
+        assert catalog['a18sm-il.dat'] == ((1.0, 0.0, 1.0), (0.0, 0.0, 0.0))
+        assert catalog['a18-il.dat'] == foil
+        catalog.close()
+    finally:
+        shutil.rmtree(tmp)
+        shutil.rmtree(tmp2)
+
+
+def test_05():
+    "catalog directories"
+    import shutil
+    tmp = _mk_testdir()
+    old = os.environ.get('WHICHFOIL_PATH')
+    try:
+        os.environ['WHICHFOIL_PATH'] = os.pathsep.join([tmp, '/does/not/exist'])
+        assert get_directories() == [get_foils_dir(), tmp]
+    finally:
+        if old is None:
+            del os.environ['WHICHFOIL_PATH']
+        else:
+            os.environ['WHICHFOIL_PATH'] = old
+        shutil.rmtree(tmp)
+
+
+def test_06():
+    "surface table"
+    import shutil
+    from .matching import MatchEngine
+    tmp = _mk_testdir()
+    tmp2 = _mk_testdir(('clarky-il.dat', 'ag03-il.dat'))
+    try:
+        catalog = Catalog()
+        catalog.add_directory(tmp, os.path.join(tmp, 'cache', 'test.cache'))
+        catalog.add_directory(tmp2, os.path.join(tmp, 'cache', 'test2.cache'))
+        foils = dict(catalog.items())
+        for stations in ((0.25, 0.5, 0.75), (0.1, 0.5)):
+            e1 = MatchEngine(catalog, stations)
+            e2 = MatchEngine(foils, stations)
+            assert e1.names == e2.names
+            assert e1.columns == e2.columns
+        # other stations are interpolated from the table
+        e1 = MatchEngine(catalog, (0.012, 0.333, 0.9))
+        e2 = MatchEngine(foils, (0.012, 0.333, 0.9))
+        for c1, c2 in zip(e1.columns, e2.columns):
+            for a, b in zip(c1, c2):
+                assert abs(a-b) < 1e-3
+        # stations before the second table sample are exact
+        e1 = MatchEngine(catalog, (0.002, 0.004, 0.5))
+        e2 = MatchEngine(foils, (0.002, 0.004, 0.5))
+        assert repr(e1.columns) == repr(e2.columns)
+        assert all(v == v for column in e1.columns for v in column)
+        catalog.close()
+    finally:
+        shutil.rmtree(tmp)
+        shutil.rmtree(tmp2)
+
+
+def test_07():
+    "geometric properties"
+    import shutil
+    from .shape import PropertyIndex
+    tmp = _mk_testdir()
+    try:
+        catalog = Catalog()
+        catalog.add_directory(tmp, os.path.join(tmp, 'cache', 'test.cache'))
+        i1 = PropertyIndex(catalog)
+        i2 = PropertyIndex(dict(catalog.items()))
+        assert i1.names == i2.names
+        for key in PROPERTIES:
+            assert repr(i1.columns[key]) == repr(i2.columns[key])
+        assert i1.query(dict(thickness=(0.1, 0.2))) == \
+            i2.query(dict(thickness=(0.1, 0.2)))
+        catalog.close()
+    finally:
+        shutil.rmtree(tmp)
+
+
+def test_08():
+    "cache directory not writable"
+    tmp = _mk_testdir()
+    try:
+        # a file where the cache directory should be
+        blocked = os.path.join(tmp, 'blocked')
+        open(blocked, 'w').close()
+        catalog = Catalog()
+        catalog.add_directory(tmp, os.path.join(blocked, 'test.cache'))
+        assert catalog.keys() == ['a18-il.dat', 'a18sm-il.dat', 'clarky-il.dat']
+        assert catalog._sources[0].filename.startswith(get_fallback_dir())
+        assert catalog['clarky-il.dat'] == catalog.read('clarky-il.dat')
+        catalog.close()
+    finally:
+        shutil.rmtree(tmp)
+
+
+def test_09():
+    "unreadable files"
+    tmp = _mk_testdir()
+    try:
+        os.mkdir(os.path.join(tmp, 'weird.dat'))
+        cachefile = os.path.join(tmp, 'cache', 'test.cache')
+        catalog = Catalog()
+        catalog.add_directory(tmp, cachefile)
+        assert catalog.keys() == ['a18-il.dat', 'a18sm-il.dat', 'clarky-il.dat']
+        assert list(catalog.errors.keys()) == ['weird.dat']
+        assert catalog._sources[0].filename == cachefile
+        assert catalog._sources[0].entries[-1]['hash'] is None
+        assert catalog.rescan() == set()
+        catalog.close()
+    finally:
+        shutil.rmtree(tmp)
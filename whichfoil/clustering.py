@@ -0,0 +1,181 @@
+# -*- coding: latin-1 -*-
+
+"""
+Grouping of near-identical airfoils.
+
+Many catalog files are variants of the same airfoil, e.g. smoothed
+versions or copies under a different name. Two airfoils are near
+duplicates if their lower and upper surfaces differ by at most *eps*
+(in chord units) at each of the stations x = 0.05, 0.10, ... 0.95.
+Clusters are the connected components of this relation.
+
+Comparing all pairs is quadratic. Instead, candidate pairs are found by
+a box query in a k-d tree over the three stations 0.25, 0.5 and 0.75:
+airfoils which differ by more than *eps* there can not be near
+duplicates. Only the candidates are compared at all stations.
+
+Clustering the bundled catalog takes well under a second. The result is
+stored in the cache directory and reused as long as the catalog is
+unchanged:
+
+    python -m whichfoil.clustering [eps]
+"""
+
+import os
+import json
+
+from .matching import catalog_columns, KDTree
+from .catalog import get_cache_dir
+
+
+STATIONS = tuple(j/20.0 for j in range(1, 20))
+BLOCKING = (4, 9, 14) # the stations 0.25, 0.5 and 0.75
+EPS = 0.002
+
+
+def _find(parent, i):
+    while parent[i] != i:
+        parent[i] = parent[parent[i]]
+        i = parent[i]
+    return i
+
+
+def find_clusters(catalog, eps=EPS):
+    """Returns the clusters of near-identical airfoils in *catalog*, as
+    a list of lists of names. Airfoils without duplicates are left
+    out. The first name of each cluster is its representative."""
+    names, columns = catalog_columns(catalog, STATIONS)
+    n = len(names)
+    # airfoils not covering all stations are never clustered
+    valid = [i for i in range(n) \
+             if all(column[i] == column[i] for column in columns)]
+    blocking = []
+    for k in BLOCKING:
+        blocking.extend(columns[2*k:2*k+2])
+    tree = KDTree(blocking, valid)
+    parent = list(range(n))
+    for i in valid:
+        lo = [column[i]-eps for column in blocking]
+        hi = [column[i]+eps for column in blocking]
+        for j in tree.query_box(lo, hi):
+            if j <= i:
+                continue
+            for column in columns:
+                if abs(column[i]-column[j]) > eps:
+                    break
+            else:
+                a = _find(parent, i)
+                b = _find(parent, j)
+                if a != b:
+                    parent[b] = a
+    groups = {}
+    for i in valid:
+        groups.setdefault(_find(parent, i), []).append(names[i])
+    r = []
+    for group in groups.values():
+        if len(group) > 1:
+            # the shortest name is usually the original
+            group.sort(key=lambda name: (len(name), name))
+            r.append(group)
+    r.sort()
+    return r
+
+
+class Clusters:
+    """Maps airfoil names to clusters. *groups* is a list of clusters
+    as returned by find_clusters."""
+    def __init__(self, groups):
+        self.groups = groups
+        self._groups = {}
+        for group in groups:
+            for name in group:
+                self._groups[name] = group
+
+    def __len__(self):
+        return len(self.groups)
+
+    def representative(self, name):
+        group = self._groups.get(name)
+        if group is None:
+            return name
+        return group[0]
+
+    def members(self, name):
+        """Returns all airfoils of the cluster of *name*"""
+        return list(self._groups.get(name, [name]))
+
+    def collapse(self, names):
+        """Groups *names* by cluster. Returns a list of lists, one for
+        each cluster in the order of first occurrence in *names*."""
+        r = []
+        index = {}
+        for name in names:
+            key = self.representative(name)
+            if key in index:
+                r[index[key]].append(name)
+            else:
+                index[key] = len(r)
+                r.append([name])
+        return r
+
+
+def get_clusters_path(catalog, eps=EPS):
+    return os.path.join(get_cache_dir(), 'clusters-%s-%g.json' % \
+                        (catalog.fingerprint()[:16], eps))
+
+
+def load_clusters(catalog, eps=EPS):
+    """Returns the Clusters of *catalog*, a Catalog. They are computed
+    if there is no result for the current catalog contents."""
+    filename = get_clusters_path(catalog, eps)
+    try:
+        with open(filename) as f:
+            groups = json.load(f)
+    except (IOError, ValueError):
+        groups = find_clusters(catalog, eps)
+        try:
+            if not os.path.exists(os.path.dirname(filename)):
+                os.makedirs(os.path.dirname(filename))
+            with open(filename, 'w') as f:
+                json.dump(groups, f)
+        except (IOError, OSError): # not writable, compute next time
+            pass
+    return Clusters(groups)
+
+
+def main():
+    import sys
+    from .catalog import open_catalog
+    eps = float(sys.argv[1]) if len(sys.argv) > 1 else EPS
+    catalog = open_catalog()
+    clusters = load_clusters(catalog, eps)
+    n = sum(len(group) for group in clusters.groups)
+    print("%i clusters with %i of %i airfoils" % (len(clusters), n, len(catalog)))
+
+
+def test_00():
+    "clusters"
+    from .matching import _load_foils
+    foils = _load_foils(300)
+    groups = find_clusters(foils)
+    # reference: compare all pairs
+    names, columns = catalog_columns(foils, STATIONS)
+    pairs = set()
+    for i in range(len(names)):
+        for j in range(i+1, len(names)):
+            if all(abs(c[i]-c[j]) <= EPS for c in columns): # false for nan
+                pairs.add((names[i], names[j]))
+    clusters = Clusters(groups)
+    for a, b in pairs:
+        assert clusters.representative(a) == clusters.representative(b)
+    for group in groups:
+        assert len(group) > 1
+    assert len(groups) > 0
+    assert clusters.representative('xyz') == 'xyz'
+    group = groups[0]
+    r = clusters.collapse(['xyz']+group[::-1])
+    assert r == [['xyz'], group[::-1]]
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,257 @@
+# -*- coding: latin-1 -*-
+
+"""
+Automatic extraction of the airfoil outline from the image.
+
+The gray image is split into foreground and background by a global
+threshold, which is chosen from the histogram (Otsu's method). The
+foreground is the darker class, or the lighter one if dark pixels are
+the majority. The foreground is decomposed into horizontal runs, and
+the runs are joined to connected components. The airfoil is taken to
+be the largest component which does not touch the image border; grid
+lines and frames usually do. Its boundary is followed pixel by pixel
+and simplified to a polygon.
+
+All steps work on whole rows or on the runs and the boundary, so a
+downscaled image of about 500 pixels is processed in a fraction of a
+second.
+"""
+
+import re
+from collections import Counter
+
+
+def otsu_threshold(gray):
+    """Returns the threshold t for the gray values *gray* (a bytes
+    object) which best separates the values <= t from the rest."""
+    hist = [0]*256
+    for v, n in Counter(gray).items():
+        hist[v] = n
+    total = len(gray)
+    sum_all = sum(v*n for v, n in enumerate(hist))
+    best = -1.0
+    threshold = 0
+    n0 = 0
+    sum0 = 0
+    for t in range(255):
+        n0 += hist[t]
+        sum0 += t*hist[t]
+        n1 = total-n0
+        if n0 == 0 or n1 == 0:
+            continue
+        m0 = sum0/float(n0)
+        m1 = (sum_all-sum0)/float(n1)
+        between = n0*n1*(m0-m1)**2
+        if between > best:
+            best = between
+            threshold = t
+    return threshold
+
+
+def binarize(gray, threshold):
+    """Returns a mask with 1 for foreground pixels and 0 otherwise"""
+    table = bytes(1 if v <= threshold else 0 for v in range(256))
+    mask = gray.translate(table)
+    if 2*mask.count(1) > len(mask):
+        mask = mask.translate(bytes(1-v if v < 2 else v for v in range(256)))
+    return mask
+
+
+_run_re = re.compile(b'\x01+')
+
+def _find(parent, i):
+    while parent[i] != i:
+        parent[i] = parent[parent[i]]
+        i = parent[i]
+    return i
+
+
+def components(mask, width, height):
+    """Returns the 8-connected components of *mask* as a list of lists
+    of runs (y, x0, x1), where x1 is exclusive."""
+    runs = []
+    parent = []
+    last = [] # indices of the runs in the previous row
+    for y in range(height):
+        row = mask[y*width:(y+1)*width]
+        current = []
+        k = 0
+        for m in _run_re.finditer(row):
+            x0, x1 = m.span()
+            i = len(runs)
+            runs.append((y, x0, x1))
+            parent.append(i)
+            current.append(i)
+            # runs of the previous row touching x0-1 ... x1
+            while k < len(last) and runs[last[k]][2] < x0:
+                k += 1
+            j = k
+            while j < len(last) and runs[last[j]][1] <= x1:
+                a = _find(parent, i)
+                b = _find(parent, last[j])
+                if a != b:
+                    parent[b] = a
+                j += 1
+        last = current
+    groups = {}
+    for i in range(len(runs)):
+        groups.setdefault(_find(parent, i), []).append(runs[i])
+    return list(groups.values())
+
+
+def _choose(groups, width, height):
+    # The largest component which does not touch the border
+    best = None
+    best_area = 0
+    best_inner = False
+    for runs in groups:
+        area = sum(x1-x0 for (y, x0, x1) in runs)
+        inner = not any(y == 0 or y == height-1 or x0 == 0 or x1 == width \
+                        for (y, x0, x1) in runs)
+        if (inner, area) > (best_inner, best_area):
+            best = runs
+            best_area = area
+            best_inner = inner
+    return best
+
+
+# Neighbours in the order of the chain code. y points down.
+_steps = ((1, 0), (1, -1), (0, -1), (-1, -1), (-1, 0), (-1, 1), (0, 1), (1, 1))
+
+def trace_boundary(runs, width, height):
+    """Returns the outer boundary of the component *runs* as a list of
+    pixel positions (x, y)."""
+    inside = bytearray(width*height)
+    for y, x0, x1 in runs:
+        inside[y*width+x0:y*width+x1] = b'\x01'*(x1-x0)
+    # the first run is the topmost, leftmost pixel
+    y, x0, x1 = min(runs)
+    start = x0, y
+    def get(x, y):
+        return 0 <= x < width and 0 <= y < height and inside[y*width+x]
+    r = [start]
+    x, y = start
+    d = 7
+    first = None
+    for i in range(4*len(inside)): # bound for safety
+        k = (d+7)%8 if d%2 == 0 else (d+6)%8
+        for j in range(8):
+            dx, dy = _steps[(k+j)%8]
+            if get(x+dx, y+dy):
+                d = (k+j)%8
+                break
+        else:
+            break # single pixel
+        if (x, y) == start:
+            if first is None:
+                first = d
+            elif d == first:
+                break
+        x += dx
+        y += dy
+        r.append((x, y))
+    if len(r) > 1 and r[-1] == start:
+        del r[-1]
+    return r
+
+
+def simplify(points, tolerance):
+    """Douglas-Peucker simplification of the closed polygon *points*"""
+    n = len(points)
+    if n < 4:
+        return list(points)
+    # split at the point farthest from the first one
+    x0, y0 = points[0]
+    far = max(range(n), key=lambda i: (points[i][0]-x0)**2+(points[i][1]-y0)**2)
+    keep = [False]*(n+1)
+    keep[0] = keep[far] = keep[n] = True
+    closed = list(points)+[points[0]]
+    stack = [(0, far), (far, n)]
+    while stack:
+        a, b = stack.pop()
+        ax, ay = closed[a]
+        bx, by = closed[b]
+        dx = bx-ax
+        dy = by-ay
+        l = (dx*dx+dy*dy)**0.5 or 1.0
+        dmax = 0.0
+        imax = None
+        for i in range(a+1, b):
+            px, py = closed[i]
+            d = abs(dx*(py-ay)-dy*(px-ax))/l
+            if d > dmax:
+                dmax = d
+                imax = i
+        if imax is not None and dmax > tolerance:
+            keep[imax] = True
+            stack.append((a, imax))
+            stack.append((imax, b))
+    return [points[i] for i in range(n) if keep[i]]
+
+
+def extract_contour(gray, width, height, tolerance=1.0):
+    """Returns the outline of the airfoil in the gray image *gray* (one
+    byte per pixel) as a list of points (x, y) in pixel coordinates,
+    or an empty list if there is no foreground."""
+    mask = binarize(gray, otsu_threshold(gray))
+    groups = components(mask, width, height)
+    if not groups:
+        return []
+    runs = _choose(groups, width, height)
+    # pixel centers
+    return [(x+0.5, y+0.5) for (x, y) in \
+            simplify(trace_boundary(runs, width, height), tolerance)]
+
+
+
+def test_00():
+    "threshold, components and boundary"
+    gray = bytes([20]*10+[200]*30)
+    t = otsu_threshold(gray)
+    assert 20 <= t < 200
+    assert binarize(gray, t) == bytes([1]*10+[0]*30)
+    # the minority class is the foreground
+    assert binarize(bytes([20]*30+[200]*10), t) == bytes([0]*30+[1]*10)
+    mask = bytes([
+        1, 1, 0, 0, 0,
+        0, 0, 0, 1, 0,
+        0, 0, 1, 1, 0,
+        0, 0, 0, 0, 0,
+        ])
+    groups = components(mask, 5, 4)
+    assert sorted(groups) == [[(0, 0, 2)], [(1, 3, 4), (2, 2, 4)]]
+    # diagonal neighbours are connected
+    groups = components(bytes([1, 0, 0, 1]), 2, 2)
+    assert len(groups) == 1
+    # a 3x3 square
+    runs = [(y, 1, 4) for y in range(1, 4)]
+    r = trace_boundary(runs, 5, 5)
+    assert len(r) == 8 and len(set(r)) == 8
+    assert (2, 2) not in r
+    assert simplify(r, 0.1) == [(1, 1), (1, 3), (3, 3), (3, 1)]
+
+
+def test_01():
+    "airfoil contour"
+    from .matching import _load_foils
+    from .fitting import _mk_image
+    from .airfoil import Airfoil
+    xv, yv = _load_foils()['clarky-il.dat']
+    p1 = (20.0, 60.0)
+    p2 = (220.0, 60.0)
+    width, height = 240, 110
+    data = bytearray(_mk_image(xv, yv, p1, p2, 1.0, width, height))
+    # a grid line touching the border, which must be ignored
+    data[3*width*100:3*width*101] = b'\x00'*(3*width)
+    gray = bytes(data[1::3])
+    points = extract_contour(gray, width, height)
+    assert 10 < len(points) < 200
+    xs = [x for (x, y) in points]
+    assert abs(min(xs)-p1[0]) < 2 and abs(max(xs)-p2[0]) < 2
+    foil = Airfoil(xv, yv)
+    for x, y in points:
+        u = (x-p1[0])/200.0
+        if 0.05 < u < 0.95:
+            lower, upper = foil.surface(u)
+            v = (p1[1]-y)/200.0
+            assert min(abs(v-lower), abs(v-upper)) < 0.015
@@ -1,27 +1,102 @@
 import json
+from json.encoder import encode_basestring_ascii
 import os
 import sys
 from .documentnode import DocumentNode, attribute
 from .viewbase import ViewBase
+from .matching import surface_values
+from .imagedata import ImageData, iter_chunks, CHUNKSIZE
     
 
 
 magic = 'profile_analyzer_0.0'
 
+# The image file is stored as a JSON string, one character per byte.
+# It is written and read in chunks, so that only the ImageData holds
+# the complete image.
+_bmp_key = '"_bmp": "'
+
+def _find_quote(s):
+    # Index of the first unescaped quote in *s* or -1
+    i = s.find('"')
+    while i >= 0:
+        j = i
+        while j > 0 and s[j-1] == '\\':
+            j -= 1
+        if (i-j)%2 == 0:
+            return i
+        i = s.find('"', i+1)
+    return -1
+
+def _safe_cut(s):
+    # Length of the longest prefix of *s* not ending inside an escape
+    n = len(s)
+    i = s.rfind('\\', max(0, n-6))
+    if i < 0:
+        return n
+    j = i
+    while j > 0 and s[j-1] == '\\':
+        j -= 1
+    if (i-j)%2 == 1:
+        return n # i ends an escaped backslash
+    if i+1 < n and s[i+1] != 'u':
+        length = 2
+    else:
+        length = 6
+    if i+length > n:
+        return i
+    return n
+
+def _unescape(s):
+    return json.loads('"%s"' % s).encode('latin-1')
+
+def _read_state(f):
+    # Returns the state of the document file *f*. The image is read
+    # into an ImageData.
+    parts = [] # the json text without the image
+    s = ''
+    k = len(_bmp_key)-1
+    while True:
+        chunk = f.read(CHUNKSIZE)
+        s += chunk
+        i = s.find(_bmp_key)
+        if i >= 0:
+            break
+        if not chunk:
+            parts.append(s)
+            return json.loads(''.join(parts))
+        parts.append(s[:-k])
+        s = s[-k:]
+    parts.append(s[:i+k])
+    parts.append('null')
+    s = s[i+k+1:]
+    data = ImageData()
+    while True:
+        i = _find_quote(s)
+        if i >= 0:
+            data.write(_unescape(s[:i]))
+            parts.append(s[i+1:])
+            break
+        i = _safe_cut(s)
+        data.write(_unescape(s[:i]))
+        s = s[i:]
+        chunk = f.read(CHUNKSIZE)
+        if not chunk:
+            raise Exception("Unexpected end of file.")
+        s += chunk
+    parts.append(f.read())
+    state = json.loads(''.join(parts))
+    state['_bmp'] = data.finish()
+    return state
+
 def load_model(filename):
     f = open(filename, "r")
-    s = f.read()
-    if not s.startswith(magic):
-        raise Exception("Unknown file format.")
-    else:
-        s = s[len(magic):]
-    state = json.loads(s)
-    if '_bmp' in state:
-        if bytes == str: # python 2
-            state['_bmp'] = state['_bmp'].encode('latin-1')
-        else:
-            # XXX python 3 only!!
-            state['_bmp'] = bytes(state['_bmp'], 'latin-1')
+    try:
+        if f.read(len(magic)) != magic:
+            raise Exception("Unknown file format.")
+        state = _read_state(f)
+    finally:
+        f.close()
     model = AnalysisModel()
     model.__setstate__(state)
     return model
@@ -33,7 +108,9 @@ class AnalysisModel(DocumentNode):
     p1 = attribute("p1", "reference point leading edge")
     p2 = attribute("p2", "reference point trailing edge")
     sliders = attribute("sliders", "tuple of sliders positions")
-    bmp = attribute("bmp", "imagefile bytes array (py3) or string (py2)")
+    stations = attribute("stations", "tuple of chord positions of the sliders")
+    outline = attribute("outline", "traced airfoil outline in image coordinates")
+    bmp = attribute("bmp", "imagefile contents, ImageData or bytes")
     airfoil = attribute("airfoil")
     yfactor = attribute("yfactor")
     focus = attribute("focus")
@@ -54,20 +131,56 @@ class AnalysisModel(DocumentNode):
     _p1 = 0, 50
     _p2 = 100, 50
     _sliders = (0.2, -0.2)*3
+    _stations = 0.25, 0.5, 0.75
+    _outline = ()
     _bmp = None
     _airfoil = None
     _yfactor = 1.0
     
     
+    def set_stations(self, stations):
+        # Each station has two sliders. Sliders of remaining stations
+        # are kept, new sliders are placed on the airfoil if there is
+        # one.
+        sliders = self._sliders
+        old = dict(zip(self._stations, zip(sliders[0::2], sliders[1::2])))
+        l = []
+        for x in stations:
+            if x in old:
+                l.extend(old[x])
+            elif self._airfoil is not None:
+                name, (xv, yv) = self._airfoil
+                lower, upper = surface_values(x, xv, yv)
+                if lower == lower:
+                    l.extend((upper, lower))
+                else:
+                    l.extend((0.2, -0.2))
+            else:
+                l.extend((0.2, -0.2))
+        self._stations = tuple(stations)
+        self._sliders = tuple(l)
+
     def save_as(self, filename):
         state = self.__getstate__()
-        bmp = self.bmp
-        if bmp is not None:
-            state['_bmp'] = bmp.decode('latin-1')
+        bmp = state.pop('_bmp', None)
         s = json.dumps(state, indent=4)
         f = open(filename, 'w')
-        f.write(magic)
-        f.write(s)
+        try:
+            f.write(magic)
+            if bmp is None:
+                f.write(s)
+                return
+            # The image comes first, so that it can be read in chunks
+            f.write('{\n    '+_bmp_key)
+            for chunk in iter_chunks(bmp):
+                f.write(encode_basestring_ascii(str(chunk, 'latin-1'))[1:-1])
+            f.write('"')
+            if state:
+                f.write(',\n'+s[2:])
+            else:
+                f.write('\n}')
+        finally:
+            f.close()
 
     def __getstate__(self):
         d = self.__dict__.copy()
@@ -95,6 +208,9 @@ class TestView(ViewBase):
     def zoom_changed(self, obj, old):
         self.messages.append([obj, old]) 
 
+    def attributes_changed(self, obj, old):
+        self.messages.append([obj, old])
+
         
 def test_00():
     "set attributes"
@@ -112,6 +228,19 @@ def xxxtest_01():
     s = cPickle.dumps(m1)
     m2 = cPickle.loads(s)
 
+def test_01():
+    "stations"
+    m = AnalysisModel()
+    m.sliders = (0.1, -0.1, 0.2, -0.2, 0.3, -0.3)
+    m.stations = (0.1, 0.5, 0.75)
+    assert m.sliders == (0.2, -0.2, 0.2, -0.2, 0.3, -0.3)
+    m.airfoil = "test", ((1.0, 0.0, 1.0), (0.1, 0.0, -0.1))
+    m.stations = (0.5, 0.75, 0.9)
+    assert m.sliders[:4] == (0.2, -0.2, 0.3, -0.3)
+    assert abs(m.sliders[4]-0.09) < 1e-12
+    assert abs(m.sliders[5]+0.09) < 1e-12
+
+
 def test_02():
     "save / load"
     m1 = AnalysisModel()
@@ -123,6 +252,37 @@ def test_02():
     m2 = load_model("tmp.wpf")
     assert m2.bmp == m1.bmp
 
+    # all escapes, split at chunk boundaries
+    m1.bmp = bytes(range(256))*20000+b'\\'
+    m1.sliders = (0.1, -0.1)
+    m1.save_as("tmp.wpf")
+    f = open("tmp.wpf")
+    s = f.read()
+    f.close()
+    state = json.loads(s[len(magic):])
+    assert state['_sliders'] == [0.1, -0.1]
+    assert bytes(state['_bmp'], 'latin-1') == m1.bmp
+    m2 = load_model("tmp.wpf")
+    assert m2.bmp == m1.bmp
+    assert m2.sliders == [0.1, -0.1]
+    os.remove("tmp.wpf")
+
+
+def test_03():
+    "set several attributes"
+    m = AnalysisModel()
+    v = TestView()
+    v.set_model(m)
+    m.set_attributes(p1=(1, 2), p2=(3, 4), yfactor=1.0)
+    assert v.messages == [[m, dict(p1=(0, 50), p2=(100, 50))]]
+    assert m.p1 == (1, 2) and m.p2 == (3, 4)
+    m.set_attributes(p1=(1, 2))
+    assert len(v.messages) == 1
+    # a single change is reported as for set_attribute
+    m.set_attributes(p1=(5, 6), zoom=2.0)
+    m.set_attributes(p1=(5, 6), zoom=3.0)
+    assert v.messages[1:] == [[m, dict(p1=(1, 2), zoom=1.0)], [m, 2.0]]
+
     
 if __name__ == '__main__':
     test_00()
@@ -76,19 +76,35 @@ class DocumentNode(Model):
         return getattr(self, '_'+name, None)
 
     def set_attribute(self, name, value):
-        old = getattr(self, '_'+name, None)
-        if old == value:
+        self.set_attributes(**{name : value})
+
+    def set_attributes(self, **kw):
+        """Sets several attributes with a single notification. Views
+        receive <name>_changed if one attribute changed, or
+        attributes_changed with a dict {name : old value} if several
+        changed."""
+        changed = {}
+        for name, value in kw.items():
+            old = getattr(self, '_'+name, None)
+            if old == value:
+                continue
+            if isinstance(old, DocumentNode):
+                OWNERS.remove_owner(old, self, name)
+            if isinstance(value, DocumentNode):
+                OWNERS.add_owner(value, self, name)
+            if hasattr(self, "set_"+name):
+                getattr(self, "set_"+name)(value)
+            else:
+                setattr(self, '_'+name, value)
+            changed[name] = old
+        if not changed:
             return
-        if isinstance(old, DocumentNode):
-            OWNERS.remove_owner(old, self, name)
-        if isinstance(value, DocumentNode):
-            OWNERS.add_owner(value, self, name)
-        if hasattr(self, "set_"+name):
-            getattr(self, "set_"+name)(value)
+        # notify views that attributes changed
+        if len(changed) == 1:
+            (name, old), = changed.items()
+            self.notify_views(name+'_changed', old)
         else:
-            setattr(self, '_'+name, value)
-        # notify views that attribute changed
-        self.notify_views(name+'_changed', old)
+            self.notify_views('attributes_changed', changed)
         self.notify_owners()
         
             
@@ -0,0 +1,287 @@
+# -*- coding: latin-1 -*-
+
+"""
+Automatic refinement of the airfoil fit.
+
+The airfoil overlay is placed by the reference points p1, p2 and the
+y-scale factor. Refinement moves the overlay so that the airfoil
+contour lies on the strongest edges of the image. The parameters are
+the chord center, chord length, chord angle and yfactor. The edge
+response is only evaluated at about a hundred points along the
+contour, and the number of evaluations is bounded, so the cost does
+not depend on the image size. Only the part of the image around the
+airfoil (see fit_region) needs to be converted to gray values.
+"""
+
+from math import sqrt, atan2, cos, sin
+
+from .matching import resample_outline
+
+
+class EdgeImage:
+    """Edge response of an RGB image.
+
+    *data* is the RGB buffer (3 bytes per pixel, as returned by
+    wx.Image.GetData), *width* and *height* its size. The green
+    channel serves as gray value, which is good enough for edges and
+    can be extracted without looping over the pixels. If the buffer
+    is a part of a larger image, *origin* is the position of its
+    upper left corner; positions are always in image coordinates.
+    """
+    def __init__(self, data, width, height, origin=(0, 0)):
+        self.gray = bytes(data[1::3])
+        self.width = width
+        self.height = height
+        self.origin = origin
+
+    def value(self, x, y):
+        # bilinear interpolation of the gray value, zero outside
+        x -= self.origin[0]
+        y -= self.origin[1]
+        ix = int(x//1)
+        iy = int(y//1)
+        w = self.width
+        if ix < 0 or iy < 0 or ix >= w-1 or iy >= self.height-1:
+            return 0.0
+        g = self.gray
+        i = iy*w+ix
+        wx = x-ix
+        a = g[i]+(g[i+1]-g[i])*wx
+        b = g[i+w]+(g[i+w+1]-g[i+w])*wx
+        return a+(b-a)*(y-iy)
+
+    def response(self, x, y, h):
+        """Returns the gradient magnitude at (x, y), computed with
+        differences over +-*h* pixels."""
+        v = self.value
+        gx = v(x+h, y)-v(x-h, y)
+        gy = v(x, y+h)-v(x, y-h)
+        return sqrt(gx*gx+gy*gy)/(2*h)
+
+
+def params_from_points(p1, p2, yfactor):
+    """Returns the fit parameters (cx, cy, length, angle, yfactor)"""
+    dx = p2[0]-p1[0]
+    dy = p2[1]-p1[1]
+    return [0.5*(p1[0]+p2[0]), 0.5*(p1[1]+p2[1]), sqrt(dx*dx+dy*dy),
+            atan2(dy, dx), yfactor]
+
+
+def points_from_params(params):
+    """Returns the tuple (p1, p2, yfactor)"""
+    cx, cy, length, angle, yfactor = params
+    dx = 0.5*length*cos(angle)
+    dy = 0.5*length*sin(angle)
+    return (cx-dx, cy-dy), (cx+dx, cy+dy), yfactor
+
+
+def profile2image(params, points):
+    # Maps *points* from profile to image coordinates, as
+    # Canvas.get_profile2image together with yfactor.
+    cx, cy, length, angle, yfactor = params
+    c = cos(angle)
+    s = sin(angle)
+    x1 = cx-0.5*length*c
+    y1 = cy-0.5*length*s
+    fy = length*yfactor
+    # profile y points upwards, i.e. along the chord direction rotated
+    # by -90 degrees in image coordinates
+    return [(x1+length*x*c+fy*y*s, y1+length*x*s-fy*y*c) for (x, y) in points]
+
+
+def image2profile(params, points):
+    # Inverse of profile2image
+    cx, cy, length, angle, yfactor = params
+    c = cos(angle)
+    s = sin(angle)
+    x1 = cx-0.5*length*c
+    y1 = cy-0.5*length*s
+    fy = length*yfactor
+    r = []
+    for x, y in points:
+        dx = x-x1
+        dy = y-y1
+        r.append(((dx*c+dy*s)/length, (dx*s-dy*c)/fy))
+    return r
+
+
+def nelder_mead(f, x0, steps, maxiter=200, tol=1e-4, maxevals=None):
+    """Minimizes *f* starting at *x0*. *steps* gives the size of the
+    initial simplex in each dimension. Stops after about *maxevals*
+    evaluations of *f*. Returns the tuple (x, f(x), evaluations)."""
+    n = len(x0)
+    evals = [0]
+    _f = f
+    def f(x):
+        evals[0] += 1
+        return _f(x)
+    simplex = [list(x0)]
+    for i in range(n):
+        x = list(x0)
+        x[i] += steps[i]
+        simplex.append(x)
+    values = [f(x) for x in simplex]
+    for it in range(maxiter):
+        order = sorted(range(n+1), key=values.__getitem__)
+        simplex = [simplex[i] for i in order]
+        values = [values[i] for i in order]
+        if abs(values[-1]-values[0]) <= tol*(abs(values[0])+tol):
+            break
+        if maxevals is not None and evals[0] >= maxevals:
+            break
+        centroid = [sum(x[i] for x in simplex[:-1])/n for i in range(n)]
+        worst = simplex[-1]
+        def towards(t):
+            return [c+t*(w-c) for (c, w) in zip(centroid, worst)]
+        xr = towards(-1.0)
+        fr = f(xr)
+        if fr < values[0]:
+            xe = towards(-2.0)
+            fe = f(xe)
+            if fe < fr:
+                simplex[-1], values[-1] = xe, fe
+            else:
+                simplex[-1], values[-1] = xr, fr
+        elif fr < values[-2]:
+            simplex[-1], values[-1] = xr, fr
+        else:
+            xc = towards(0.5)
+            fc = f(xc)
+            if fc < values[-1]:
+                simplex[-1], values[-1] = xc, fc
+            else: # shrink towards the best point
+                best = simplex[0]
+                for i in range(1, n+1):
+                    simplex[i] = [b+0.5*(x-b) for (b, x) in zip(best, simplex[i])]
+                    values[i] = f(simplex[i])
+    i = min(range(n+1), key=values.__getitem__)
+    return simplex[i], values[i], evals[0]
+
+
+def fit_region(p1, p2, yfactor, width, height, margin=0.1):
+    """Returns the rectangle (x, y, w, h) of an image of size *width* x
+    *height* which the airfoil placed at p1, p2 can reach during
+    refine_fit. Only this part of the image needs to be passed to
+    EdgeImage."""
+    dx = p2[0]-p1[0]
+    dy = p2[1]-p1[1]
+    length = sqrt(dx*dx+dy*dy)
+    # airfoils are well within +-0.25 chords around the chord line
+    d = length*(margin+0.25*max(1.0, yfactor))
+    x0 = max(0, int(min(p1[0], p2[0])-d))
+    y0 = max(0, int(min(p1[1], p2[1])-d))
+    x1 = min(width, int(max(p1[0], p2[0])+d)+1)
+    y1 = min(height, int(max(p1[1], p2[1])+d)+1)
+    return x0, y0, max(0, x1-x0), max(0, y1-y0)
+
+
+def refine_fit(image, xv, yv, p1, p2, yfactor, npoints=120,
+               scales=(8.0, 4.0, 2.0), maxrotation=0.05, maxevals=600):
+    """Optimizes p1, p2 and yfactor so that the airfoil (xv, yv) lies
+    on the edges of *image*, an EdgeImage.
+
+    The optimization runs from coarse to fine edge scales (in pixels).
+    The chord angle may change by at most *maxrotation* radians. At
+    most about *maxevals* positions are evaluated, which bounds the
+    run time to well below a second. Returns the tuple (p1, p2,
+    yfactor).
+    """
+    points = resample_outline(list(zip(xv, yv)), npoints)
+    params = params_from_points(p1, p2, yfactor)
+    angle0 = params[3]
+    length = params[2]
+    budget = maxevals
+    for k, h in enumerate(scales):
+        # the remaining budget is shared by the remaining scales
+        share = budget//(len(scales)-k)
+        def f(params):
+            if abs(params[3]-angle0) > maxrotation or params[2] <= 0 \
+               or params[4] <= 0:
+                return 0.0
+            total = 0.0
+            response = image.response
+            for x, y in profile2image(params, points):
+                total += response(x, y, h)
+            return -total/len(points)
+        steps = (h, h, 2*h, h/length, 0.05)
+        # restart until the simplex stops making progress
+        value = f(params)
+        used = 1
+        for i in range(5):
+            params, new, evals = nelder_mead(f, params, steps,
+                                             maxevals=share-used)
+            used += evals
+            if new >= value-1e-3*abs(value) or used >= share:
+                break
+            value = new
+        budget -= used
+    return points_from_params(params)
+
+
+def _mk_image(xv, yv, p1, p2, yfactor, width, height):
+    # Renders a dark airfoil on white ground
+    from .airfoil import Airfoil
+    foil = Airfoil(xv, yv)
+    params = params_from_points(p1, p2, yfactor)
+    cx, cy, length, angle, yfactor = params
+    data = bytearray(b'\xff'*(3*width*height))
+    x1, y1 = points_from_params(params)[0]
+    for iy in range(height):
+        for ix in range(width):
+            # inverse of profile2image for angle 0
+            x = (ix-x1)/length
+            y = (y1-iy)/(length*yfactor)
+            if 0 <= x <= 1:
+                lower, upper = foil.surface(x)
+                if lower <= y <= upper:
+                    k = 3*(iy*width+ix)
+                    data[k:k+3] = b'\x20\x20\x20'
+    return bytes(data)
+
+
+def test_00():
+    "transformations"
+    params = params_from_points((10, 50), (110, 40), 1.2)
+    p1, p2, yfactor = points_from_params(params)
+    assert abs(p1[0]-10) < 1e-9 and abs(p2[1]-40) < 1e-9
+    (a, b, c) = profile2image(params, [(0, 0), (1, 0), (0, 0.1)])
+    assert abs(a[0]-10) < 1e-9 and abs(a[1]-50) < 1e-9
+    assert abs(b[0]-110) < 1e-9 and abs(b[1]-40) < 1e-9
+    # y up means decreasing image y for a horizontal chord
+    params = params_from_points((0, 50), (100, 50), 1.0)
+    (c, ) = profile2image(params, [(0, 0.1)])
+    assert abs(c[0]) < 1e-9 and abs(c[1]-40) < 1e-9
+    params = params_from_points((10, 50), (110, 40), 1.2)
+    points = [(0.3, 0.05), (0.9, -0.02)]
+    for a, b in zip(image2profile(params, profile2image(params, points)), points):
+        assert abs(a[0]-b[0]) < 1e-9 and abs(a[1]-b[1]) < 1e-9
+
+
+def test_01():
+    "refine fit"
+    import io, os
+    from .airfoil import load_airfoil
+    path = os.path.join(os.path.dirname(__file__), 'foils', 'clarky-il.dat')
+    comments, (xv, yv) = load_airfoil(io.open(path, encoding='latin-1'))
+    p1 = (40.0, 80.0)
+    p2 = (360.0, 80.0)
+    import time
+    data = _mk_image(xv, yv, p1, p2, 1.0, 400, 150)
+    image = EdgeImage(data, 400, 150)
+    t = time.time()
+    r1, r2, yfactor = refine_fit(image, xv, yv, (43.0, 82.0), (355.0, 79.0), 0.9)
+    assert time.time()-t < 1.0
+    for a, b in zip(r1+r2, p1+p2):
+        assert abs(a-b) < 1.5
+    assert abs(yfactor-1.0) < 0.05
+    # a part of the image gives the same result
+    assert fit_region((43.0, 82.0), (355.0, 79.0), 0.9, 400, 150) == \
+        (0, 0, 400, 150)
+    assert fit_region((100.0, 80.0), (200.0, 80.0), 1.0, 400, 150, 0.0) == \
+        (75, 55, 151, 51)
+    x, y, w, h = 20, 20, 370, 120
+    rows = [data[3*(400*j+x):3*(400*j+x+w)] for j in range(y, y+h)]
+    part = EdgeImage(b''.join(rows), w, h, (x, y))
+    assert part.value(200.5, 80.5) == image.value(200.5, 80.5)
+    assert refine_fit(part, xv, yv, (43.0, 82.0), (355.0, 79.0), 0.9) == \
+        (r1, r2, yfactor)
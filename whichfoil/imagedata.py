@@ -0,0 +1,165 @@
+# -*- coding: latin-1 -*-
+
+"""
+Storage for the contents of image files.
+
+Scans can be large. ImageData keeps the file contents in an anonymous
+temporary file which is mapped into memory, so that they do not occupy
+the Python heap. The decoder reads from a stream over the mapping and
+the document writer encodes the contents chunk by chunk, so that no
+complete copy is made.
+
+ImageData behaves like a read-only bytes object for indexing, slicing,
+len and comparison.
+"""
+
+import mmap
+import tempfile
+from io import BytesIO
+
+
+CHUNKSIZE = 1<<20
+
+
+class ImageData:
+    """Image file contents. Use *write* to add data and *finish* when
+    done, or one of the constructors from_file and from_bytes."""
+    def __init__(self):
+        self._file = tempfile.TemporaryFile()
+        self._map = None
+        self._size = 0
+
+    @classmethod
+    def from_file(cls, filename):
+        data = cls()
+        with open(filename, 'rb') as f:
+            while True:
+                s = f.read(CHUNKSIZE)
+                if not s:
+                    break
+                data.write(s)
+        return data.finish()
+
+    @classmethod
+    def from_bytes(cls, s):
+        data = cls()
+        data.write(s)
+        return data.finish()
+
+    def write(self, s):
+        if self._map is not None:
+            raise ValueError("ImageData is read-only.")
+        self._file.write(s)
+        self._size += len(s)
+
+    def finish(self):
+        """Maps the written data. Returns self."""
+        self._file.flush()
+        if self._size:
+            self._map = mmap.mmap(self._file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+        else:
+            self._map = b''
+        return self
+
+    def close(self):
+        if self._map:
+            self._map.close()
+        self._file.close()
+
+    def __len__(self):
+        return self._size
+
+    def __getitem__(self, key):
+        return self._map[key]
+
+    def view(self):
+        """Returns a memoryview of the data"""
+        return memoryview(self._map)
+
+    def chunks(self, size=CHUNKSIZE):
+        """Yields the data as memoryviews of at most *size* bytes"""
+        view = self.view()
+        for i in range(0, len(view), size):
+            yield view[i:i+size]
+
+    def stream(self):
+        """Returns a new readable file object over the data"""
+        if not self._size:
+            return BytesIO()
+        # each mapping has its own position
+        return mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __eq__(self, other):
+        if isinstance(other, ImageData):
+            other = other.view()
+        elif not isinstance(other, (bytes, bytearray, memoryview)):
+            return NotImplemented
+        if len(self) != len(other):
+            return False
+        other = memoryview(other)
+        i = 0
+        for chunk in self.chunks():
+            if chunk != other[i:i+len(chunk)]:
+                return False
+            i += len(chunk)
+        return True
+
+    def __ne__(self, other):
+        r = self.__eq__(other)
+        if r is NotImplemented:
+            return r
+        return not r
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '<ImageData, %i bytes>' % self._size
+
+
+def open_stream(data):
+    """Returns a readable file object over *data*, which is either
+    ImageData or bytes."""
+    if isinstance(data, ImageData):
+        return data.stream()
+    return BytesIO(data)
+
+
+def iter_chunks(data, size=CHUNKSIZE):
+    """Yields *data*, ImageData or bytes, in chunks of at most *size*
+    bytes"""
+    if isinstance(data, ImageData):
+        for chunk in data.chunks(size):
+            yield chunk
+    else:
+        view = memoryview(data)
+        for i in range(0, len(view), size):
+            yield view[i:i+size]
+
+
+
+def test_00():
+    "image data"
+    s = open("test/ah79k135.gif", "rb").read()
+    data = ImageData.from_file("test/ah79k135.gif")
+    assert len(data) == len(s)
+    assert data[:6] == s[:6]
+    assert data == s and s == data
+    assert data == ImageData.from_bytes(s)
+    assert data != s[:-1]+b'x'
+    assert b''.join(bytes(c) for c in iter_chunks(data, 1000)) == s
+    assert b''.join(bytes(c) for c in iter_chunks(s, 1000)) == s
+    f1 = open_stream(data)
+    f2 = open_stream(data)
+    assert f1.read(10) == s[:10]
+    assert f2.read() == s
+    assert f1.read(5) == s[10:15]
+    empty = ImageData().finish()
+    assert len(empty) == 0 and empty == b''
+    assert open_stream(empty).read() == b''
+    try:
+        data.write(b'x')
+    except ValueError:
+        pass
+    else:
+        assert False
@@ -3,19 +3,25 @@
 import wx
 import os
 import sys
+import atexit
+import threading
+import multiprocessing
 import pkg_resources
-try:
-    import importlib_resources as resources # py2
-except:
-    from importlib import resources # py3
 
 from math import pi
 from .menu import mk_menu
 from .document import AnalysisModel, load_model
-from .view import Canvas
-from .airfoil import load_airfoil, interpolate_airfoil
+from .view import Canvas, EVT_SLIDERS
 from .bindwx import Binder, TextBinder, InvalidValue
-from . import foils
+from .catalog import open_catalog, get_cache_dir
+from .matching import MatchEngine, LiveQuery, OutlineMatcher, \
+    ResultCache, quantize
+from .sharding import ShardedEngine
+from .clustering import load_clusters
+from .search import SearchIndex
+from .shape import PropertyIndex, parse_ranges
+from .fitting import EdgeImage, refine_fit, fit_region
+from .imagedata import ImageData
 
 
 DEBUG = False
@@ -49,6 +55,20 @@ class FloatBinder(TextBinder):
         return str(value)
 
 
+class StationsBinder(TextBinder):
+    def fromstr(self, s):
+        try:
+            stations = sorted(set(float(x) for x in s.replace(',', ' ').split()))
+        except ValueError:
+            raise InvalidValue(s)
+        if not stations or stations[0] < 0 or stations[-1] > 1:
+            raise InvalidValue(s)
+        return tuple(stations)
+
+    def tostr(self, value):
+        return u" ".join("%g" % x for x in value)
+
+
 class VectorBinder(Binder):
     def __init__(self, model, attrname, widget1, widget2):
         self.widget1 = widget1
@@ -81,27 +101,135 @@ def read_airfoils():
     global _airfoils
     if _airfoils is not None:
         return _airfoils
-    d = {}
-    # This drives me nuts! Resources in python3.8 does not have "files"!
-    if hasattr(resources, 'files'):
-        files = resources.files(foils)
-        for p in files.iterdir():
-            if not p.name.lower().endswith('.dat'):
-                continue
-            f = p.open(encoding='latin-1')
-            comments, (xl, yl) = load_airfoil(f)
-            foilname = p.name
-            d[foilname] = xl, yl
-    else:
-        contents = resources.contents(foils)
-        for p in contents:
-            if not p.lower().endswith('.dat'):
-                continue
-            f = resources.open_text(foils, p, encoding='latin-1')
-            comments, (xl, yl) = load_airfoil(f)
-            d[p] = xl, yl
-    _airfoils = d
-    return d
+    # Parsing all files takes seconds. The catalog therefore reads
+    # from cache files, which are updated if necessary. Coordinates
+    # are only loaded when needed. Additional directories can be set
+    # in WHICHFOIL_PATH.
+    _airfoils = open_catalog()
+    return _airfoils
+
+
+_engine = None
+_sharding_threshold = 100000 # catalog size for multiprocess matching
+def get_match_engine(stations):
+    # The engine precomputes the surface values of all airfoils at
+    # the stations. It is rebuilt when the catalog or the stations
+    # have changed. Very large catalogs are searched by worker
+    # processes, one shard per cpu.
+    global _engine
+    catalog = read_airfoils()
+    stations = tuple(stations)
+    if _engine is None or _engine.version != catalog.version or \
+       _engine.stations != stations:
+        if _engine is not None:
+            _engine.close()
+        if len(catalog) >= _sharding_threshold and \
+           multiprocessing.cpu_count() > 1:
+            _engine = ShardedEngine(catalog, stations)
+        else:
+            _engine = MatchEngine(catalog, stations)
+    return _engine
+
+
+_results = None
+def get_result_cache():
+    # Match results of recent queries. They are also kept on disk, so
+    # that repeated queries are fast after a restart.
+    global _results
+    if _results is None:
+        filename = os.path.join(get_cache_dir(), 'results')
+        _results = ResultCache(256, filename)
+        atexit.register(_results.close)
+    return _results
+
+
+def cached_match(stations, sliders, delta):
+    # Returns the names of matching airfoils. Queries are quantized,
+    # so that almost identical sliders give identical results.
+    sliders = quantize(sliders)
+    key = 'match', sliders, delta, tuple(stations), \
+          read_airfoils().fingerprint()
+    cache = get_result_cache()
+    r = cache.get(key)
+    if r is None:
+        r = get_match_engine(stations).match(sliders, delta)
+        cache.put(key, r)
+    return r
+
+
+def cached_rank(stations, sliders, k):
+    # Returns the best *k* airfoils as list of (name, score)
+    sliders = quantize(sliders)
+    key = 'rank', sliders, k, tuple(stations), \
+          read_airfoils().fingerprint()
+    cache = get_result_cache()
+    r = cache.get(key)
+    if r is None:
+        r = get_match_engine(stations).rank(sliders, k)
+        cache.put(key, r)
+    return r
+
+
+_clusters = None
+def get_clusters():
+    # Clusters of near-identical airfoils. They are stored in the
+    # cache directory and only computed when the catalog changed.
+    global _clusters
+    catalog = read_airfoils()
+    if _clusters is None or _clusters[0] != catalog.version:
+        _clusters = catalog.version, load_clusters(catalog)
+    return _clusters[1]
+
+
+_search_index = None
+def get_search_index():
+    global _search_index
+    catalog = read_airfoils()
+    if _search_index is None or _search_index[0] != catalog.version:
+        entries = [(name, catalog.get_comments(name)) for name in catalog]
+        _search_index = catalog.version, SearchIndex(entries)
+    return _search_index[1]
+
+
+_property_index = None
+def get_property_index():
+    global _property_index
+    catalog = read_airfoils()
+    if _property_index is None or _property_index.version != catalog.version:
+        _property_index = PropertyIndex(catalog)
+    return _property_index
+
+
+def add_ranges_ctrl(parent, sizer, handler):
+    # Adds a text field for property ranges such as "thickness
+    # 12-14%, camber < 2%". Returns the text control.
+    s = wx.BoxSizer(wx.HORIZONTAL)
+    l = wx.StaticText(parent, label="properties:")
+    s.Add(l, 0, wx.ALL|wx.ALIGN_CENTER_VERTICAL, 5)
+    t = wx.TextCtrl(parent, style=wx.TE_PROCESS_ENTER)
+    t.SetToolTip("e.g. thickness 12-14%, camber < 2%")
+    t.Bind(wx.EVT_TEXT_ENTER, handler)
+    s.Add(t, 1, wx.ALL, 5)
+    sizer.Add(s, 0, wx.EXPAND)
+    return t
+
+
+def read_ranges(t):
+    # Returns the ranges entered in *t*. Invalid input is ignored.
+    try:
+        return parse_ranges(t.Value)
+    except ValueError:
+        wx.Bell()
+        return {}
+
+
+_outline_matcher = None
+def get_outline_matcher():
+    global _outline_matcher
+    catalog = read_airfoils()
+    if _outline_matcher is None or _outline_matcher.version != catalog.version:
+        _outline_matcher = OutlineMatcher(catalog)
+    return _outline_matcher
 
     
 class AirfoilBrowser(wx.Frame):
@@ -114,8 +242,10 @@ class AirfoilBrowser(wx.Frame):
 
         t = wx.SearchCtrl(self, style=wx.TE_PROCESS_ENTER)
         t.Bind(wx.EVT_TEXT_ENTER, self.on_filter)
+        t.Bind(wx.EVT_TEXT, self.on_filter)
         self.t = t
         s.Add(t, 0, wx.EXPAND|wx.ALL, 5)
+        self.t_ranges = add_ranges_ctrl(self, s, self.on_filter)
         
         lb = wx.ListBox(self)
         lb.Bind(wx.EVT_LISTBOX_DCLICK, self.on_load)
@@ -129,16 +259,22 @@ class AirfoilBrowser(wx.Frame):
         self.Show()
         self.on_filter()
         
-    def apply_filter(self, pattern):
-        r = set()
-        pattern = pattern.lower()
-        for name, foil in self.foils.items():
-            if pattern in name.lower():
-                r.add(name)
-        self.lb.SetItems(sorted(r))
+    maxresults = 2000 # number of airfoils listed for a search
+    def apply_filter(self, pattern, ranges=None):
+        # Searches names and header comments, best matches first.
+        # *ranges* restricts the geometric properties.
+        if pattern.strip():
+            limit = None if ranges else self.maxresults
+            r = get_search_index().search(pattern, limit)
+        else:
+            r = self.foils.keys()
+        if ranges:
+            allowed = get_property_index().query(ranges)
+            r = [name for name in r if name in allowed][:self.maxresults]
+        self.lb.SetItems(r)
 
     def on_filter(self, event=None):
-        self.apply_filter(self.t.Value)
+        self.apply_filter(self.t.Value, read_ranges(self.t_ranges))
 
     def on_load(self, event):
         i = event.GetSelection()
@@ -161,6 +297,9 @@ class AirfoilMatcher(wx.Frame):
         b = wx.Button(self, label="filter")
         b.Bind(wx.EVT_BUTTON, self.on_filter)
         s.Add(b, 0, wx.EXPAND)
+        b = wx.Button(self, label="match outline")
+        b.Bind(wx.EVT_BUTTON, self.on_match_outline)
+        s.Add(b, 0, wx.EXPAND)
 
         s2 = wx.BoxSizer(wx.HORIZONTAL)
         l = wx.StaticText(self, label="delta:")
@@ -171,43 +310,161 @@ class AirfoilMatcher(wx.Frame):
         self.t = t
         s2.Add(t, 0, wx.ALL, 5)
         s.Add(s2, 0)         
+        self.t_ranges = add_ranges_ctrl(self, s, self.on_filter)
+
+        c = wx.CheckBox(self, label="rank best matches")
+        c.Bind(wx.EVT_CHECKBOX, self.on_filter)
+        s.Add(c, 0, wx.ALL, 5)
+        self.c_rank = c
+
+        s3 = wx.BoxSizer(wx.HORIZONTAL)
+        c = wx.CheckBox(self, label="group near-duplicates")
+        c.Bind(wx.EVT_CHECKBOX, self.on_group)
+        s3.Add(c, 1, wx.ALL, 5)
+        self.c_group = c
+        b = wx.Button(self, label="expand")
+        b.Bind(wx.EVT_BUTTON, self.on_expand)
+        s3.Add(b, 0, wx.ALL, 5)
+        s.Add(s3, 0, wx.EXPAND)
+        
         self.Sizer = s
         self.lb = lb
+        self.names = []
+        self.results = [] # list of (name, label)
+        self.expanded = set()
+
+        # Results follow the sliders while they are dragged
+        main.canvas.Bind(EVT_SLIDERS, self.on_sliders)
+        self.Bind(wx.EVT_WINDOW_DESTROY, self.on_destroy)
         self.Show()
+
+    _query = None
+    def get_query(self, stations, delta):
+        # The query is kept while dragging, so that the candidates
+        # found in the tree can be reused.
+        engine = get_match_engine(stations)
+        query = self._query
+        if query is None or query.engine is not engine or query.delta != delta:
+            query = self._query = LiveQuery(engine, delta)
+        return query
         
-    def apply_filter(self, sliders25, sliders50, sliders75, delta=0.005):
-        r = set()
-        positions = [0.25, 0.5, 0.75]
-        sliders = sliders25, sliders50, sliders75
-        for name, foil in self.foils.items():
-            xv, yv = foil
-            ok = True
-            for sx, sy in zip(positions, sliders):                
-                values = interpolate_airfoil(sx, xv, yv)
-                if not values:
-                     ok = False
-                     break
-                y1 = min(values)
-                y2 = max(values)
-                lower = min(sy)
-                upper = max(sy)
-                if abs(y1-lower) > delta:
-                     ok = False
-                     break
-                if abs(y2-upper) > delta:
-                     ok = False
-                     break
-            if ok:
-                r.add(name)
-        self.lb.SetItems(sorted(r))
-
-    def on_filter(self, event):
-        delta = float(self.t.Value)
-        sliders = self.main.document.sliders
-        sliders25 = sliders[0:2]
-        sliders50 = sliders[2:4]
-        sliders75 = sliders[4:6]
-        self.apply_filter(sliders25, sliders50, sliders75, delta)
+    def apply_filter(self, stations, sliders, delta=0.005, cached=True):
+        # Live updates bypass the result cache, as dragged sliders
+        # rarely repeat.
+        if cached:
+            r = cached_match(stations, sliders, delta)
+        else:
+            r = self.get_query(stations, delta).match(sliders)
+        self.show_results([(name, name) for name in r])
+
+    nranked = 50 # number of airfoils shown in rank mode
+    def apply_ranking(self, stations, sliders, cached=True):
+        if cached:
+            r = cached_rank(stations, sliders, self.nranked)
+        else:
+            r = get_match_engine(stations).rank(sliders, self.nranked)
+        self.show_results([(name, u"%s  (%.4f)" % (name, score)) \
+                           for (name, score) in r])
+
+    def apply_outline_ranking(self, outline):
+        matcher = get_outline_matcher()
+        r = matcher.rank(outline, self.nranked)
+        self.show_results([(name, u"%s  (%.4f)" % (name, score)) \
+                           for (name, score) in r])
+
+    def show_results(self, results):
+        # *results* is a list of (name, label). In group mode, only the
+        # best entry of each cluster is listed unless it is expanded.
+        ranges = read_ranges(self.t_ranges)
+        if ranges:
+            allowed = get_property_index().query(ranges)
+            results = [(name, label) for (name, label) in results \
+                       if name in allowed]
+        self.results = results
+        if not self.c_group.Value:
+            self.names = [name for (name, label) in results]
+            self.lb.SetItems([label for (name, label) in results])
+            return
+        labels = dict(results)
+        names = []
+        items = []
+        clusters = get_clusters()
+        for group in clusters.collapse([name for (name, label) in results]):
+            first = group[0]
+            if len(group) == 1:
+                names.append(first)
+                items.append(labels[first])
+            elif clusters.representative(first) in self.expanded:
+                for name in group:
+                    names.append(name)
+                    items.append(labels[name])
+            else:
+                names.append(first)
+                items.append(u"%s  [+%i]" % (labels[first], len(group)-1))
+        self.names = names
+        self.lb.SetItems(items)
+
+    def on_group(self, event):
+        self.expanded = set()
+        self.show_results(self.results)
+
+    def on_expand(self, event):
+        # Expands or collapses the cluster of the selected airfoil
+        i = self.lb.GetSelection()
+        if i == wx.NOT_FOUND or not self.c_group.Value:
+            return
+        key = get_clusters().representative(self.names[i])
+        if key in self.expanded:
+            self.expanded.remove(key)
+        else:
+            self.expanded.add(key)
+        self.show_results(self.results)
+
+    def on_match_outline(self, event):
+        # The outline is compared with the airfoil as drawn, i.e. with
+        # y scaled by yfactor.
+        yfactor = self.main.document.yfactor
+        outline = self.main.canvas.get_outline()
+        self.apply_outline_ranking([(x, y/yfactor) for (x, y) in outline])
+
+    def on_filter(self, event=None, sliders=None):
+        document = self.main.document
+        stations = document.stations
+        cached = sliders is None
+        if sliders is None:
+            sliders = document.sliders
+        # one pair of sliders for each station
+        sliders = list(zip(sliders[0::2], sliders[1::2]))
+        if self.c_rank.Value:
+            self.apply_ranking(stations, sliders, cached)
+        else:
+            delta = float(self.t.Value)
+            self.apply_filter(stations, sliders, delta, cached)
+
+    live_delay = 40 # ms between updates while dragging
+    _live_timer = None
+    _live_sliders = None
+    def on_sliders(self, event):
+        event.Skip()
+        # Mouse moves come faster than the list can be redrawn. Only
+        # the latest sliders are matched when the timer fires.
+        self._live_sliders = event.sliders
+        if self._live_timer is None:
+            self._live_timer = wx.CallLater(self.live_delay, self.update_live)
+
+    def update_live(self):
+        self._live_timer = None
+        try:
+            self.on_filter(sliders=self._live_sliders)
+        except ValueError: # invalid delta or number of sliders
+            pass
+
+    def on_destroy(self, event):
+        event.Skip()
+        if event.GetEventObject() is self:
+            self.main.canvas.Unbind(EVT_SLIDERS, handler=self.on_sliders)
+            if self._live_timer is not None:
+                self._live_timer.Stop()
 
     def on_delta(self, event):
         t = self.t
@@ -222,7 +479,7 @@ class AirfoilMatcher(wx.Frame):
                 
     def on_load(self, event):
         i = event.GetSelection()
-        name = self.lb.Items[i]
+        name = self.names[i]
         airfoil = self.foils[name]
         self.main.document.airfoil = name, airfoil
         
@@ -232,7 +489,10 @@ class MainWindow(wx.Frame):
     image_entries = ['load_image', 'flip_image']
     view_entries = ['zoomin', 'zoomout', 'moveleft', 'moveright', 'moveup', 'movedown',
                     'rotateleft', 'rotateright', None, 'reset_view']
-    airfoil_entries = ['reset_airfoil', 'open_browser', 'open_matcher']
+    airfoil_entries = ['reset_airfoil', 'refine_fit', 'open_browser',
+                       'open_matcher', None, 'trace_outline', 'clear_outline',
+                       'detect_outline', 'use_detected_outline', None,
+                       'rescan_airfoils']
     debug_entries = ['open_notebook', 'open_shell']
 
     _filename = None
@@ -288,6 +548,12 @@ class MainWindow(wx.Frame):
         t.Bind(wx.EVT_BUTTON, self.open_matcher)
         sizer2.Add(t)
         
+        l = wx.StaticText(panel, label=_("stations:"))
+        sizer2.Add(l)
+        t = wx.TextCtrl(panel, style=wx.TE_PROCESS_ENTER)
+        sizer2.Add(t)
+        StationsBinder(document, 'stations', t)
+
         l = wx.StaticText(panel, label=_("hue:"))
         sizer2.Add(l)
         t = wx.TextCtrl(panel, style=wx.TE_PROCESS_ENTER)
@@ -362,6 +628,29 @@ class MainWindow(wx.Frame):
         self.browser = AirfoilBrowser(self)
         # store it for debugging and scripting
             
+    def trace_outline(self):
+        "Trace outline on/off"
+        self.canvas.tracing = not self.canvas.tracing
+
+    def clear_outline(self):
+        "Clear outline"
+        self.document.outline = ()
+
+    def detect_outline(self):
+        "Detect outline on/off"
+        self.canvas.set_show_contour(not self.canvas.show_contour)
+
+    def can_use_detected_outline(self):
+        return bool(self.canvas.contour)
+
+    def use_detected_outline(self):
+        "Use detected outline"
+        self.document.outline = tuple(self.canvas.contour)
+
+    def rescan_airfoils(self):
+        "Rescan airfoil directories"
+        read_airfoils().rescan()
+            
     def new(self):
         "New Window"
         f = MainWindow(None)
@@ -427,27 +716,75 @@ class MainWindow(wx.Frame):
         self.Close(True)
 
     def read_image(self, path):
-        s = open(path, "rb").read()
+        # The file is read and decoded in the background. Airfoil and
+        # view are reset once the image size is known.
+        def read():
+            try:
+                s = ImageData.from_file(path)
+            except Exception as e:
+                wx.CallAfter(self.show_error, 'Open image file',
+                             'Can not read %s:\n%s' % (path, e))
+            else:
+                wx.CallAfter(self.set_image, s)
+        thread = threading.Thread(target=read)
+        thread.daemon = True
+        thread.start()
+
+    def show_error(self, title, message):
+        if not self: # window closed meanwhile
+            return
+        dlg = wx.MessageDialog(self, message, title, wx.OK | wx.ICON_ERROR)
+        dlg.ShowModal()
+        dlg.Destroy()
+
+    def set_image(self, s):
         model = self.document
         model.bmp = s
         model.mirror = False
         model.alpha = 0.0
-        self.reset_airfoil()
-        self.reset_view()
+        def reset():
+            self.reset_airfoil()
+            self.reset_view()
+        self.canvas.call_when_loaded(reset)
 
     def reset_airfoil(self):
         "Reset airfoil"
-        w, h = self.canvas.bmp.Size
+        w, h = self.canvas.get_image_size()
         model = self.document
         model.p1 = 0.1*w, 0.5*h
         model.p2 = 0.9*w, 0.5*h
-        model.sliders = (0.2, -0.2)*3
+        model.sliders = (0.2, -0.2)*len(model.stations)
         model.airfoil = None
         model.yfactor = 1.0
         
+    def can_refine_fit(self):
+        return self.document.airfoil is not None and \
+            self.canvas.image is not None
+
+    def refine_fit(self):
+        "Refine fit"
+        model = self.document
+        im = self.canvas.image
+        # only the part around the airfoil is converted
+        w, h = im.GetSize()
+        x, y, w, h = fit_region(model.p1, model.p2, model.yfactor, w, h)
+        if not w or not h: # airfoil outside of the image
+            wx.Bell()
+            return
+        part = im.GetSubImage(wx.Rect(x, y, w, h))
+        image = EdgeImage(part.GetData(), w, h, (x, y))
+        name, (xv, yv) = model.airfoil
+        wx.BeginBusyCursor()
+        try:
+            p1, p2, yfactor = refine_fit(
+                image, xv, yv, model.p1, model.p2, model.yfactor)
+        finally:
+            wx.EndBusyCursor()
+        model.set_attributes(p1=p1, p2=p2, yfactor=yfactor)
+        
     def reset_view(self):
         "Reset view"
-        w, h = self.canvas.bmp.Size
+        w, h = self.canvas.get_image_size()
         model = self.document
         model.scale = 1.0
         model.xshift = 0
@@ -585,11 +922,13 @@ def test_00():
     doc = main.document
     doc.bmp = s
     doc.hue = 0.8
-    w, h = main.canvas.bmp.Size
-    doc.focus = 0.5*w, 0.5*h
-    doc.p1 = (148.0, 433.0)
-    doc.p2 = (1087.0, 437.0)
-    doc.sliders = (0.0885, -0.0361, 0.0940, -0.0351, 0.0513, -0.0224)
+    def loaded():
+        w, h = main.canvas.get_image_size()
+        doc.focus = 0.5*w, 0.5*h
+        doc.p1 = (148.0, 433.0)
+        doc.p2 = (1087.0, 437.0)
+        doc.sliders = (0.0885, -0.0361, 0.0940, -0.0351, 0.0513, -0.0224)
+    main.canvas.call_when_loaded(loaded)
     if 0:
         try:
             main.open_notebook(locals())
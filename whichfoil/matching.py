@@ -0,0 +1,787 @@
+# -*- coding: latin-1 -*-
+
+"""
+Matching of slider positions against an airfoil catalog.
+
+The matcher compares the lower and upper surface of each airfoil at a
+few chord positions (stations) with the slider values. Instead of
+interpolating every airfoil for every query, the surface values are
+computed once per catalog and stored columnwise: one array per
+station and surface. Together the columns form a signature vector
+for each airfoil.
+
+The stations can be chosen freely. The catalog stores the lower and
+upper surface of all airfoils at every 0.5% chord (the surface
+table). The columns for any station are interpolated from the two
+neighbouring table samples. Tolerance and nearest neighbour queries are
+answered by a k-d tree over these vectors, so that a query only
+visits a small part of the catalog.
+"""
+
+import dbm
+import time
+import shelve
+from array import array
+from collections import OrderedDict
+from heapq import heappush, heapreplace, nsmallest
+from math import sqrt
+
+from .airfoil import Airfoil, interpolate_airfoil
+
+
+STATIONS = (0.25, 0.5, 0.75)
+TABLE_SAMPLES = 200 # table intervals, samples are at x = j/TABLE_SAMPLES
+nan = float('nan')
+
+
+def surface_values(t, xv, yv):
+    """Returns the tuple (lower, upper) of the airfoil at x=t. If the
+    airfoil does not cover t, nan is returned for both."""
+    return Airfoil(xv, yv).surface(t)
+
+
+def signature(xv, yv, stations=STATIONS):
+    """Returns the flat list [lower0, upper0, lower1, upper1, ...] of
+    the surface values at *stations*."""
+    r = []
+    for lower, upper in zip(*Airfoil(xv, yv).evaluate(stations)):
+        r.append(lower)
+        r.append(upper)
+    return r
+
+
+def surface_table(xv, yv, n=TABLE_SAMPLES):
+    """Returns the lists (lower, upper) of the surface values at x =
+    j/n for j = 0 ... n."""
+    return Airfoil(xv, yv).evaluate([j/float(n) for j in range(n+1)])
+
+
+def table_columns(catalog, stations, n=TABLE_SAMPLES):
+    """Returns the columns [lower0, upper0, lower1, upper1, ...] for
+    *stations*, interpolated from the surface table of *catalog*.
+
+    The first table sample x=0 is nan for most airfoils, as the contour
+    only touches it. Stations between 0 and the second sample are
+    therefore computed from the coordinates, which are read with
+    catalog.items().
+    """
+    rows = {}
+    def get_rows(j):
+        if not j in rows:
+            rows[j] = catalog.read_table(j)
+        return rows[j]
+    for t in stations:
+        if not 0 <= t <= 1:
+            raise ValueError(t)
+    exact = sorted(set(t for t in stations if 0 < t*n < 1))
+    if exact:
+        values = dict((t, (array('d'), array('d'))) for t in exact)
+        for name, (xv, yv) in catalog.items():
+            lower, upper = Airfoil(xv, yv).evaluate(exact)
+            for t, a, b in zip(exact, lower, upper):
+                values[t][0].append(a)
+                values[t][1].append(b)
+    columns = []
+    for t in stations:
+        if t in exact:
+            columns.extend(array('d', a) for a in values[t])
+            continue
+        j = min(int(t*n), n)
+        w = t*n-j
+        for k in (0, 1):
+            a = get_rows(j)[k]
+            if w == 0:
+                columns.append(array('d', a))
+            else:
+                b = get_rows(j+1)[k]
+                columns.append(array('d', [u+(v-u)*w for (u, v) in zip(a, b)]))
+    return columns
+
+
+def catalog_columns(catalog, stations):
+    """Returns the tuple (names, columns). The columns are taken from
+    the surface table if *catalog* has one (see Catalog.read_table),
+    otherwise they are computed from the coordinates."""
+    if hasattr(catalog, 'read_table'):
+        return catalog.keys(), table_columns(catalog, stations)
+    names = []
+    columns = [array('d') for i in range(2*len(stations))]
+    for name, (xv, yv) in catalog.items():
+        names.append(name)
+        values = signature(xv, yv, stations)
+        for column, v in zip(columns, values):
+            column.append(v)
+    return names, columns
+
+
+def slider_targets(sliders):
+    """Converts the sliders, a sequence of (y1, y2) pairs, into the
+    flat list [lower0, upper0, lower1, upper1, ...]"""
+    r = []
+    for pair in sliders:
+        r.append(min(pair))
+        r.append(max(pair))
+    return r
+
+
+class KDTree:
+    """A k-d tree over points given as *columns*, a list of arrays with
+    one array per dimension. Only the points *indices* are
+    inserted.
+
+    Nodes are tuples (dim, split, left, right), leaves are lists of
+    point indices.
+    """
+    leafsize = 16
+    def __init__(self, columns, indices):
+        self.columns = columns
+        self.root = self._build(list(indices))
+
+    def _build(self, indices):
+        if len(indices) <= self.leafsize:
+            return indices
+        # split at the median of the dimension with the largest spread
+        best = None
+        for dim, column in enumerate(self.columns):
+            values = [column[i] for i in indices]
+            spread = max(values)-min(values)
+            if best is None or spread > best[0]:
+                best = spread, dim
+        spread, dim = best
+        if spread == 0: # all points equal
+            return indices
+        column = self.columns[dim]
+        indices.sort(key=column.__getitem__)
+        m = len(indices)//2
+        split = column[indices[m]]
+        return dim, split, self._build(indices[:m]), self._build(indices[m:])
+
+    def query_box(self, lo, hi):
+        """Returns the indices of all points p with lo <= p <= hi.
+        The test is done with the margin *eps* at inner nodes."""
+        r = []
+        eps = 1e-12
+        columns = self.columns
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if type(node) is list:
+                for i in node:
+                    for column, a, b in zip(columns, lo, hi):
+                        if not (a <= column[i] <= b):
+                            break
+                    else:
+                        r.append(i)
+            else:
+                dim, split, left, right = node
+                # points equal to split can be in both subtrees
+                if lo[dim]-eps <= split:
+                    stack.append(left)
+                if hi[dim]+eps >= split:
+                    stack.append(right)
+        return r
+
+    def query_knn(self, p, k):
+        """Returns the *k* points nearest to *p* as list of tuples
+        (squared distance, index) in ascending order."""
+        heap = [] # max heap of (-distance, -index)
+        columns = self.columns
+        def visit(node):
+            if type(node) is list:
+                for i in node:
+                    d = 0.0
+                    for column, v in zip(columns, p):
+                        c = column[i]-v
+                        d += c*c
+                    item = -d, -i
+                    if len(heap) < k:
+                        heappush(heap, item)
+                    elif item > heap[0]:
+                        heapreplace(heap, item)
+                return
+            dim, split, left, right = node
+            diff = p[dim]-split
+            if diff < 0:
+                near, far = left, right
+            else:
+                near, far = right, left
+            visit(near)
+            if len(heap) < k or diff*diff <= -heap[0][0]:
+                visit(far)
+        if k > 0:
+            visit(self.root)
+        return sorted((-d, -i) for (d, i) in heap)
+
+
+class MatchEngine:
+    """Matches sliders against all airfoils of *catalog*.
+
+    *catalog* is anything which provides items(), e.g. a Catalog or a
+    dict {name : (xv, yv)}. A Catalog provides the surface table, so
+    that no coordinates need to be loaded. The attribute *version* is
+    copied from the catalog, so that users can detect when the engine
+    is outdated.
+    """
+    def __init__(self, catalog, stations=STATIONS):
+        self.stations = tuple(stations)
+        self.version = getattr(catalog, 'version', None)
+        names, columns = catalog_columns(catalog, self.stations)
+        self.names = names
+        self.columns = columns
+
+        # Airfoils without values (nan) at some station can not match
+        # and are left out of the tree.
+        valid = [i for i in range(len(names)) \
+                 if all(column[i] == column[i] for column in columns)]
+        self.tree = self._mk_tree(columns, valid)
+
+    def _mk_tree(self, columns, valid):
+        # Returns the search structure. It must provide query_box and
+        # query_knn as KDTree.
+        return KDTree(columns, valid)
+
+    def __len__(self):
+        return len(self.names)
+
+    def close(self):
+        pass
+
+    def candidates(self, targets, delta):
+        # Returns the indices of all airfoils within *delta* of the
+        # flat list *targets*.
+        lo = [v-delta for v in targets]
+        hi = [v+delta for v in targets]
+        columns = self.columns
+        r = []
+        for i in self.tree.query_box(lo, hi):
+            for column, v in zip(columns, targets):
+                if abs(column[i]-v) > delta:
+                    break
+            else:
+                r.append(i)
+        r.sort()
+        return r
+
+    def rank(self, sliders, k=50):
+        """Returns the *k* airfoils best matching the *sliders*, as a
+        list of tuples (name, score) in ascending order of the score.
+
+        The score is the rms deviation of the lower and upper surface
+        values from the slider values. The best airfoils are found by
+        a nearest neighbour search in the k-d tree.
+        """
+        targets = slider_targets(sliders)
+        if len(targets) != len(self.columns):
+            raise ValueError("Expected %i slider pairs" % len(self.stations))
+        n = len(targets)
+        names = self.names
+        return [(names[i], sqrt(d/n)) for (d, i) in self.tree.query_knn(targets, k)]
+
+    def match(self, sliders, delta):
+        """Returns the names of all airfoils whose lower and upper
+        surface are within *delta* of the *sliders*. *sliders* is a
+        sequence of (y1, y2) pairs, one for each station."""
+        targets = slider_targets(sliders)
+        if len(targets) != len(self.columns):
+            raise ValueError("Expected %i slider pairs" % len(self.stations))
+        names = self.names
+        return [names[i] for i in self.candidates(targets, delta)]
+
+
+class LiveQuery:
+    """Repeated matches for slowly moving sliders, e.g. while a slider
+    is dragged.
+
+    The tree is queried with *delta*+*margin*. As long as the query box
+    of later sliders stays within these bounds, the result is filtered
+    from the stored candidates without touching the tree.
+    """
+    def __init__(self, engine, delta, margin=None):
+        self.engine = engine
+        self.delta = delta
+        if margin is None:
+            margin = max(delta, 0.005)
+        self.margin = margin
+        self._lo = self._hi = None
+        self._candidates = ()
+
+    def match(self, sliders):
+        """Returns the names of all airfoils within *delta* of
+        *sliders*, as MatchEngine.match."""
+        engine = self.engine
+        targets = slider_targets(sliders)
+        if len(targets) != len(engine.columns):
+            raise ValueError("Expected %i slider pairs" % len(engine.stations))
+        delta = self.delta
+        lo = [v-delta for v in targets]
+        hi = [v+delta for v in targets]
+        if self._lo is None or \
+           any(a < b for (a, b) in zip(lo, self._lo)) or \
+           any(a > b for (a, b) in zip(hi, self._hi)):
+            d = delta+self.margin
+            self._candidates = engine.candidates(targets, d)
+            self._lo = [v-d for v in targets]
+            self._hi = [v+d for v in targets]
+        columns = engine.columns
+        names = engine.names
+        r = []
+        for i in self._candidates:
+            for column, v in zip(columns, targets):
+                if abs(column[i]-v) > delta:
+                    break
+            else:
+                r.append(names[i])
+        return r
+
+
+
+def quantize(sliders, quantum=1e-4):
+    """Rounds the (y1, y2) pairs in *sliders* to multiples of
+    *quantum*. Returns a tuple of tuples, suitable as cache key."""
+    return tuple(tuple(round(v/quantum)*quantum for v in pair) \
+                 for pair in sliders)
+
+
+class ResultCache:
+    """A bounded LRU cache for match results.
+
+    Keys must have a stable repr. If *filename* is given, results are
+    also stored in a shelve database, so that they survive a
+    restart. The dbm modules do no locking, so the database may be
+    damaged if several processes write to it. The disk tier is
+    silently dropped if the database can not be opened, read or
+    written.
+
+    The database holds at most *maxdisk* entries. Each entry is stored
+    with the time it was written. When the database is full, it is
+    rewritten with the newer half of the entries. Rewriting is needed
+    because some dbm implementations never shrink their files.
+    """
+    def __init__(self, maxsize=128, filename=None, maxdisk=4096):
+        self.maxsize = maxsize
+        self.maxdisk = maxdisk
+        self.filename = filename
+        self._lru = OrderedDict()
+        self._shelf = None
+        self._ndisk = 0
+        if filename is not None:
+            try:
+                self._shelf = shelve.open(filename)
+                self._ndisk = len(self._shelf)
+                if self._ndisk > maxdisk:
+                    self._prune()
+            except dbm.error+(OSError,):
+                self._shelf = None
+
+    def __len__(self):
+        return len(self._lru)
+
+    def get(self, key, default=None):
+        lru = self._lru
+        try:
+            value = lru.pop(key)
+        except KeyError:
+            if self._shelf is None:
+                return default
+            try:
+                item = self._shelf[repr(key)]
+            except KeyError:
+                return default
+            except Exception: # damaged database
+                self._drop_shelf()
+                return default
+            if type(item) is not tuple: # written by an older version
+                return default
+            value = item[1]
+        self._put(key, value)
+        return value
+
+    def _put(self, key, value):
+        lru = self._lru
+        lru.pop(key, None)
+        if len(lru) >= self.maxsize:
+            lru.popitem(last=False)
+        lru[key] = value
+
+    def put(self, key, value):
+        self._put(key, value)
+        shelf = self._shelf
+        if shelf is not None:
+            try:
+                k = repr(key)
+                if k not in shelf:
+                    self._ndisk += 1
+                shelf[k] = time.time(), value
+                if self._ndisk > self.maxdisk:
+                    self._prune()
+            except Exception:
+                self._drop_shelf()
+
+    def _prune(self):
+        # Rewrites the database with the newer half of the entries
+        shelf = self._shelf
+        items = []
+        for k in list(shelf.keys()):
+            try:
+                item = shelf[k]
+            except Exception: # unreadable, dropped
+                continue
+            if type(item) is tuple:
+                items.append((item[0], k, item))
+        items.sort()
+        items = items[len(items)-self.maxdisk//2:]
+        shelf.close()
+        self._shelf = shelf = shelve.open(self.filename, 'n')
+        for t, k, item in items:
+            shelf[k] = item
+        self._ndisk = len(items)
+
+    def _drop_shelf(self):
+        # Disables the disk tier after an error
+        shelf = self._shelf
+        self._shelf = None
+        if shelf is not None:
+            try:
+                shelf.close()
+            except Exception:
+                pass
+
+    def close(self):
+        if self._shelf is not None:
+            self._shelf.close()
+            self._shelf = None
+
+
+class MemoryTable:
+    """Provides the surface table of the airfoils in *catalog* (e.g. a
+    dict {name : (xv, yv)}) in the interface of Catalog."""
+    def __init__(self, catalog, n=TABLE_SAMPLES):
+        self.version = getattr(catalog, 'version', None)
+        self.names = []
+        tables = []
+        for name, (xv, yv) in catalog.items():
+            self.names.append(name)
+            tables.append(surface_table(xv, yv, n))
+        self.tables = tables
+
+    def keys(self):
+        return list(self.names)
+
+    def read_table(self, j):
+        lower = array('d', [table[0][j] for table in self.tables])
+        upper = array('d', [table[1][j] for table in self.tables])
+        return lower, upper
+
+
+def resample_outline(points, n=100):
+    """Returns *n* points equally spaced along the polyline *points*"""
+    if len(points) < 2:
+        return list(points)
+    lengths = [0.0]
+    for (x1, y1), (x2, y2) in zip(points[:-1], points[1:]):
+        lengths.append(lengths[-1]+sqrt((x2-x1)**2+(y2-y1)**2))
+    total = lengths[-1]
+    if total == 0:
+        return [points[0]]
+    r = []
+    i = 1
+    for k in range(n):
+        s = total*k/float(n-1)
+        while i < len(lengths)-1 and lengths[i] < s:
+            i += 1
+        l = lengths[i]-lengths[i-1]
+        w = (s-lengths[i-1])/l if l else 0.0
+        (x1, y1), (x2, y2) = points[i-1], points[i]
+        r.append((x1+(x2-x1)*w, y1+(y2-y1)*w))
+    return r
+
+
+class OutlineMatcher:
+    """Matches an outline against all airfoils of *catalog*.
+
+    The outline is a list of points in profile coordinates. For each
+    point the distance to the nearer surface of an airfoil is
+    estimated from the surface table: the vertical distance, scaled
+    with the local slope of the surface. The score of an airfoil is
+    the rms distance over all points.
+
+    Points are processed in batches of equal table interval, so that
+    the table rows and slopes are computed once per interval for all
+    airfoils. Table rows are cached.
+    """
+    npoints = 100 # the outline is resampled to this number of points
+    def __init__(self, catalog, n=TABLE_SAMPLES):
+        if not hasattr(catalog, 'read_table'):
+            catalog = MemoryTable(catalog, n)
+        self.catalog = catalog
+        self.version = getattr(catalog, 'version', None)
+        self.names = catalog.keys()
+        self.n = n
+        self._rows = {}
+        self._factors = {}
+
+    def __len__(self):
+        return len(self.names)
+
+    def get_rows(self, j):
+        try:
+            return self._rows[j]
+        except KeyError:
+            rows = self._rows[j] = self.catalog.read_table(j)
+            return rows
+
+    def get_factors(self, j):
+        # Returns the factors 1/sqrt(1+slope**2) of the lower and upper
+        # surfaces in table interval j
+        try:
+            return self._factors[j]
+        except KeyError:
+            pass
+        n = self.n
+        r = []
+        for a, b in zip(self.get_rows(j), self.get_rows(j+1)):
+            r.append(array('d', [1.0/sqrt(1.0+((v-u)*n)**2) for (u, v) in zip(a, b)]))
+        self._factors[j] = r
+        return r
+
+    def scores(self, points):
+        # Returns the list of summed squared distances and the number
+        # of points used.
+        n = self.n
+        batches = {}
+        for x, y in resample_outline(points, self.npoints):
+            # The table has no values at the very leading and trailing
+            # edge. The vertical distance is meaningless there anyway.
+            if not 1.0/n <= x <= 1.0-1.0/n:
+                continue
+            j = min(int(x*n), n-1)
+            batches.setdefault(j, []).append((x*n-j, y))
+        sums = [0.0]*len(self.names)
+        m = 0
+        for j, l in sorted(batches.items()):
+            lower_a, upper_a = self.get_rows(j)
+            lower_b, upper_b = self.get_rows(j+1)
+            f_lower, f_upper = self.get_factors(j)
+            for w, y in l:
+                sums = [s+min(abs(y-la-(lb-la)*w)*fl, abs(y-ua-(ub-ua)*w)*fu)**2 \
+                        for (s, la, lb, fl, ua, ub, fu) in \
+                        zip(sums, lower_a, lower_b, f_lower, upper_a, upper_b, f_upper)]
+                m += 1
+        return sums, m
+
+    def rank(self, points, k=50):
+        """Returns the *k* airfoils best matching the outline *points*
+        as a list of tuples (name, score) in ascending order of the
+        score, the rms distance."""
+        sums, m = self.scores(points)
+        if not m:
+            return []
+        # airfoils not covering all points have a nan score
+        best = nsmallest(k, ((s, i) for (i, s) in enumerate(sums) if s == s))
+        names = self.names
+        return [(names[i], sqrt(s/m)) for (s, i) in best]
+
+
+
+def _load_foils(n=None):
+    import io, os
+    from .airfoil import load_airfoil
+    path = os.path.join(os.path.dirname(__file__), 'foils')
+    names = sorted(name for name in os.listdir(path) if name.endswith('.dat'))
+    d = {}
+    for name in names[:n]:
+        f = io.open(os.path.join(path, name), encoding='latin-1')
+        comments, foil = load_airfoil(f)
+        d[name] = foil
+    return d
+
+
+def _match_reference(foils, sliders, delta):
+    # The original loop of AirfoilMatcher.apply_filter
+    r = set()
+    for name, (xv, yv) in foils.items():
+        ok = True
+        for sx, sy in zip(STATIONS, sliders):
+            values = interpolate_airfoil(sx, xv, yv)
+            if not values:
+                ok = False
+                break
+            if abs(min(values)-min(sy)) > delta:
+                ok = False
+                break
+            if abs(max(values)-max(sy)) > delta:
+                ok = False
+                break
+        if ok:
+            r.add(name)
+    return r
+
+
+def test_00():
+    "match"
+    foils = _load_foils(400)
+    engine = MatchEngine(foils)
+    assert len(engine) == 400
+    sliders = [(0.0885, -0.0361), (0.0940, -0.0351), (0.0513, -0.0224)]
+    for delta in (0.0, 0.005, 0.01, 0.02, 0.05):
+        r = engine.match(sliders, delta)
+        assert set(r) == _match_reference(foils, sliders, delta)
+    r = engine.match([(0.2, -0.2)]*3, 1.0)
+    assert r == sorted(r)
+    assert set(r) == _match_reference(foils, [(0.2, -0.2)]*3, 1.0)
+
+
+def test_01():
+    "rank"
+    foils = _load_foils(400)
+    engine = MatchEngine(foils)
+    sliders = [(0.0885, -0.0361), (0.0940, -0.0351), (0.0513, -0.0224)]
+    r = engine.rank(sliders, 10)
+    assert len(r) == 10
+    l = []
+    for name, (xv, yv) in foils.items():
+        values = []
+        for t, pair in zip(STATIONS, sliders):
+            lower, upper = surface_values(t, xv, yv)
+            values.append((lower-min(pair))**2)
+            values.append((upper-max(pair))**2)
+        score = sqrt(sum(values)/6)
+        if score == score:
+            l.append((score, name))
+    l.sort()
+    assert [name for (name, score) in r] == [name for (score, name) in l[:10]]
+    for (name, score), (score2, name2) in zip(r, l):
+        assert abs(score-score2) < 1e-12
+
+
+def test_02():
+    "kd tree"
+    import random
+    rnd = random.Random(0)
+    n = 2000
+    columns = [array('d', [rnd.random() for i in range(n)]) for j in range(4)]
+    tree = KDTree(columns, range(n))
+    for j in range(20):
+        p = [rnd.random() for i in range(4)]
+        l = []
+        for i in range(n):
+            l.append((sum((c[i]-v)**2 for (c, v) in zip(columns, p)), i))
+        l.sort()
+        r = tree.query_knn(p, 10)
+        assert [i for (d, i) in r] == [i for (d, i) in l[:10]]
+        for (d1, i1), (d2, i2) in zip(r, l):
+            assert abs(d1-d2) < 1e-12
+
+        lo = [v-0.2 for v in p]
+        hi = [v+0.2 for v in p]
+        r = [i for i in range(n) if all(a <= c[i] <= b for (c, a, b) in \
+                                        zip(columns, lo, hi))]
+        assert sorted(tree.query_box(lo, hi)) == r
+
+
+def test_03():
+    "surface table"
+    foils = _load_foils(100)
+    n = TABLE_SAMPLES
+    for name, (xv, yv) in foils.items():
+        lower, upper = surface_table(xv, yv)
+        for j in range(0, n+1):
+            a, b = surface_values(j/float(n), xv, yv)
+            assert (a == lower[j] and b == upper[j]) or \
+                (a != a and lower[j] != lower[j])
+
+
+def test_04():
+    "outline"
+    foils = _load_foils(300)
+    name = 'ah79k135-il.dat'
+    foils[name] = _load_foils()[name]
+    matcher = OutlineMatcher(foils)
+    xv, yv = foils[name]
+    # a noisy outline of the upper and part of the lower surface
+    points = [(x, y+0.001*(-1)**i) for (i, (x, y)) in enumerate(zip(xv, yv))]
+    points = points[:len(points)*3//4]
+    r = matcher.rank(points, 5)
+    assert r[0][0] == name
+    assert r[0][1] < 0.002
+    assert len(r) == 5
+    assert [score for (name, score) in r] == sorted(score for (name, score) in r)
+
+
+def test_05():
+    "live query"
+    foils = _load_foils(400)
+    engine = MatchEngine(foils)
+    query = LiveQuery(engine, 0.01)
+    sliders = [(0.0885, -0.0361), (0.0940, -0.0351), (0.0513, -0.0224)]
+    query.match(sliders)
+    candidates = query._candidates
+    for i in range(20):
+        # drag the upper slider at the second station
+        sliders[1] = (0.0940+0.001*i, -0.0351)
+        assert query.match(sliders) == engine.match(sliders, 0.01)
+        if i <= 5:
+            assert query._candidates is candidates
+    assert query._candidates is not candidates
+
+
+def test_06():
+    "result cache"
+    import os, tempfile, shutil
+    assert quantize([(0.08853, -0.03612)]) == quantize([(0.08851, -0.036118)])
+    tmp = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmp, 'results')
+        cache = ResultCache(2, filename)
+        for i in range(3):
+            cache.put(('match', i), ['a%i' % i])
+        assert len(cache) == 2
+        assert ('match', 0) not in cache._lru
+        assert cache.get(('match', 0)) == ['a0'] # from disk
+        cache.close()
+        cache = ResultCache(2, filename)
+        assert cache.get(('match', 2)) == ['a2']
+        assert cache.get(('match', 3)) is None
+        cache.close()
+        cache = ResultCache(2)
+        cache.put(1, 'x')
+        assert cache.get(1) == 'x' and cache.get(2, 'y') == 'y'
+
+        # the disk tier is bounded, too
+        filename = os.path.join(tmp, 'bounded')
+        cache = ResultCache(2, filename, maxdisk=20)
+        for i in range(100):
+            cache.put(('match', i), ['a%i' % i]*50)
+            assert len(cache._shelf) <= 20
+        assert cache.get(('match', 99)) == ['a99']*50
+        cache.close()
+        size = sum(os.path.getsize(os.path.join(tmp, name)) \
+                   for name in os.listdir(tmp) if name.startswith('bounded'))
+        cache = ResultCache(2, filename, maxdisk=20)
+        for i in range(100, 300):
+            cache.put(('match', i), ['a%i' % i]*50)
+        assert len(cache._shelf) <= 20
+        assert cache.get(('match', 0)) is None
+        cache.close()
+        size2 = sum(os.path.getsize(os.path.join(tmp, name)) \
+                    for name in os.listdir(tmp) if name.startswith('bounded'))
+        assert size2 < 2*size
+        # a smaller limit prunes on open
+        cache = ResultCache(2, filename, maxdisk=4)
+        assert len(cache._shelf) <= 2
+        assert cache.get(('match', 299)) == ['a299']*50
+        cache.close()
+
+        # a damaged record disables the disk tier
+        filename = os.path.join(tmp, 'damaged')
+        cache = ResultCache(2, filename)
+        cache.put(('match', 0), ['a0'])
+        cache._shelf.dict[repr(('match', 1))] = b'garbage'
+        assert cache.get(('match', 1), 'x') == 'x'
+        assert cache._shelf is None
+        assert cache.get(('match', 0)) == ['a0'] # still in memory
+        cache.put(('match', 2), ['a2'])
+        assert cache.get(('match', 2)) == ['a2']
+        cache.close()
+    finally:
+        shutil.rmtree(tmp)
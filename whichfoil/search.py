@@ -0,0 +1,199 @@
+# -*- coding: latin-1 -*-
+
+"""
+Search index over airfoil names and header comments.
+
+Names are indexed by all their n-grams up to length 3, so that any
+substring of a name can be found by intersecting a few posting
+lists. Comments are split into tokens, which are found by prefix.
+A query is split into terms; an airfoil matches if every term occurs
+in its name or comments. Results are ranked by
+
+    name starts with term       4
+    term occurs in name         2
+    comment token equals term   2
+    comment token starts with   1
+
+summed over the terms. While typing, each query usually extends the
+previous one. Its result can then only be a subset of the previous
+result, which is rescored instead of querying the index again.
+"""
+
+import re
+from bisect import bisect_left
+from heapq import nsmallest
+
+
+_token_re = re.compile(r'[a-z0-9]+')
+def tokenize(s):
+    return _token_re.findall(s.lower())
+
+
+def _grams(s, n=3):
+    # All substrings of *s* with length 1 ... n
+    r = set()
+    for k in range(1, n+1):
+        for i in range(len(s)-k+1):
+            r.add(s[i:i+k])
+    return r
+
+
+class SearchIndex:
+    """Index over *entries*, an iterable of (name, comments)"""
+    def __init__(self, entries):
+        self.names = []
+        self._lower = []
+        self._comments = [] # comment tokens of each airfoil
+        self._grams = {}
+        self._tokens = {}
+        for i, (name, comments) in enumerate(entries):
+            lower = name.lower()
+            self.names.append(name)
+            self._lower.append(lower)
+            for gram in _grams(lower):
+                self._grams.setdefault(gram, []).append(i)
+            tokens = sorted(set(tokenize(comments or '')))
+            self._comments.append(tokens)
+            for token in tokens:
+                self._tokens.setdefault(token, []).append(i)
+        self._sorted = sorted(self._tokens)
+        self._last = None
+
+    # Rescoring the last result is only cheaper than the index if the
+    # result is small.
+    max_rescore = 5000
+
+    def __len__(self):
+        return len(self.names)
+
+    def _match_term(self, term):
+        # Returns {index : score} for all airfoils matching *term*
+        r = {}
+        lower = self._lower
+        if len(term) <= 3:
+            ids = self._grams.get(term, ())
+        else:
+            postings = [self._grams.get(term[i:i+3], ()) \
+                        for i in range(len(term)-2)]
+            postings.sort(key=len)
+            ids = set(postings[0])
+            for posting in postings[1:]:
+                ids.intersection_update(posting)
+                if not ids:
+                    break
+            ids = [i for i in ids if term in lower[i]]
+        for i in ids:
+            r[i] = 4 if lower[i].startswith(term) else 2
+        tokens = self._sorted
+        j = bisect_left(tokens, term)
+        while j < len(tokens) and tokens[j].startswith(term):
+            token = tokens[j]
+            score = 2 if token == term else 1
+            for i in self._tokens[token]:
+                if r.get(i, 0) < score:
+                    r[i] = score
+            j += 1
+        return r
+
+    def _score(self, i, term):
+        # Score of airfoil *i* for *term*, computed without the index
+        lower = self._lower[i]
+        if lower.startswith(term):
+            return 4
+        score = 2 if term in lower else 0
+        for token in self._comments[i]:
+            if token == term:
+                return max(score, 2)
+            if token.startswith(term):
+                score = max(score, 1)
+        return score
+
+    def _extends(self, terms):
+        # True if the result of *terms* is a subset of the last result
+        if self._last is None or len(self._last[1]) > self.max_rescore:
+            return False
+        old = self._last[0]
+        if not old or len(terms) < len(old):
+            return False
+        for a, b in zip(old[:-1], terms):
+            if a != b:
+                return False
+        return terms[len(old)-1].startswith(old[-1])
+
+    def search(self, query, limit=None):
+        """Returns the names of all airfoils matching *query*, best
+        matches first. At most *limit* names are returned."""
+        terms = tokenize(query)
+        if not terms:
+            return self.names[:limit]
+        if self._extends(terms):
+            scores = {}
+            for i in self._last[1]:
+                total = 0
+                for term in terms:
+                    score = self._score(i, term)
+                    if not score:
+                        break
+                    total += score
+                else:
+                    scores[i] = total
+        else:
+            scores = None
+            for term in terms:
+                r = self._match_term(term)
+                if scores is None:
+                    scores = r
+                else:
+                    scores = dict((i, s+r[i]) for (i, s) in scores.items() \
+                                  if i in r)
+                if not scores:
+                    break
+        self._last = terms, scores
+        names = self.names
+        key = lambda item: (-item[1], names[item[0]])
+        if limit is None:
+            l = sorted(scores.items(), key=key)
+        else:
+            l = nsmallest(limit, scores.items(), key=key)
+        return [names[i] for (i, score) in l]
+
+
+
+def test_00():
+    "search"
+    entries = [
+        ('a18-il.dat', 'A18 (original)'),
+        ('a18sm-il.dat', 'A18 (smoothed)'),
+        ('clarky-il.dat', 'CLARK Y AIRFOIL'),
+        ('fx84w150-il.dat', 'FX 84-W-150'),
+        ('xa18.dat', ''),
+        ]
+    index = SearchIndex(entries)
+    assert index.search('') == [name for (name, comments) in entries]
+    assert index.search('a18') == ['a18-il.dat', 'a18sm-il.dat', 'xa18.dat']
+    assert index.search('smooth') == ['a18sm-il.dat']
+    assert index.search('clark airfoil') == ['clarky-il.dat']
+    assert index.search('84 w') == ['fx84w150-il.dat']
+    assert index.search('zzz') == []
+    assert index.search('a18', 2) == ['a18-il.dat', 'a18sm-il.dat']
+    # prefix of a comment token
+    assert index.search('ori') == ['a18-il.dat']
+
+
+def test_01():
+    "incremental search"
+    import random
+    rnd = random.Random(0)
+    words = ['naca', 'clark', 'eppler', 'wortmann', 'fx', 'goe', 'smoothed',
+             'original', 'airfoil', 'root', 'tip']
+    entries = []
+    for i in range(2000):
+        name = '%s%i-il.dat' % (rnd.choice(words), rnd.randint(0, 9999))
+        comments = ' '.join(rnd.choice(words) for j in range(3))
+        entries.append((name, comments))
+    index = SearchIndex(entries)
+    fresh = SearchIndex(entries)
+    for query in ('e', 'ep', 'epp', 'eppl', 'eppler1', 'eppler1 r',
+                  'eppler1 ro', 'go', 'goe 12', 'w', 'wo', 'wor tip'):
+        fresh._last = None
+        assert index.search(query) == fresh.search(query)
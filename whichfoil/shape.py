@@ -0,0 +1,218 @@
+# -*- coding: latin-1 -*-
+
+"""
+Geometric properties of airfoils and range queries over them.
+
+The properties are computed once when a file is added to the catalog
+cache and stored with its index entry. All lengths are in chord
+units:
+
+    thickness       maximum of upper-lower
+    thickness_pos   x where the thickness is maximal
+    camber          mean line (upper+lower)/2 with the largest magnitude
+    camber_pos      x of the maximum camber
+    le_radius       leading edge radius, estimated from the thickness
+                    close to the leading edge
+    te_thickness    gap between the first and last point
+    npoints         number of points
+
+PropertyIndex holds each property as a column together with the row
+numbers sorted by value. A range query is a bisection in the sorted
+values; several ranges are intersected.
+"""
+
+import re
+from array import array
+from bisect import bisect_left, bisect_right
+
+from .airfoil import Airfoil, nan
+from .matching import surface_table, TABLE_SAMPLES
+
+
+PROPERTIES = ('thickness', 'thickness_pos', 'camber', 'camber_pos',
+              'le_radius', 'te_thickness', 'npoints')
+
+_le_distance = 0.002 # distance from the leading edge for le_radius
+
+
+def geometric_properties(xv, yv, table=None):
+    """Returns a dict with the properties of the airfoil (xv, yv).
+
+    *table* is its surface table (lower, upper) if available. Values
+    which can not be determined are nan.
+    """
+    if table is None:
+        table = surface_table(xv, yv)
+    lower, upper = table
+    n = TABLE_SAMPLES
+    thickness = camber = nan
+    thickness_pos = camber_pos = nan
+    for j in range(n+1):
+        a = lower[j]
+        b = upper[j]
+        if a != a:
+            continue
+        t = b-a
+        c = 0.5*(a+b)
+        if not t <= thickness: # true for nan
+            thickness = t
+            thickness_pos = j/float(n)
+        if not abs(c) <= abs(camber):
+            camber = c
+            camber_pos = j/float(n)
+    le_radius = nan
+    if len(xv):
+        x0 = min(xv)+_le_distance
+        a, b = Airfoil(xv, yv).surface(x0)
+        if a == a:
+            le_radius = (0.5*(b-a))**2/(2*_le_distance)
+    te_thickness = abs(yv[0]-yv[-1]) if len(yv) else nan
+    return dict(thickness=thickness, thickness_pos=thickness_pos,
+                camber=camber, camber_pos=camber_pos, le_radius=le_radius,
+                te_thickness=te_thickness, npoints=len(xv))
+
+
+class PropertyIndex:
+    """Range queries over the geometric properties of *catalog*.
+
+    A Catalog provides the stored properties. For other catalogs, e.g.
+    a dict {name : (xv, yv)}, they are computed.
+    """
+    def __init__(self, catalog):
+        self.version = getattr(catalog, 'version', None)
+        if hasattr(catalog, 'read_properties'):
+            self.names = catalog.keys()
+            self.columns = catalog.read_properties()
+        else:
+            self.names = []
+            self.columns = dict((key, array('d')) for key in PROPERTIES)
+            for name, (xv, yv) in catalog.items():
+                self.names.append(name)
+                properties = geometric_properties(xv, yv)
+                for key in PROPERTIES:
+                    self.columns[key].append(properties[key])
+        self._sorted = {}
+
+    def __len__(self):
+        return len(self.names)
+
+    def _get_sorted(self, key):
+        # Returns the rows without nan sorted by value, and the values
+        try:
+            return self._sorted[key]
+        except KeyError:
+            column = self.columns[key]
+            rows = [i for i in range(len(column)) if column[i] == column[i]]
+            rows.sort(key=column.__getitem__)
+            values = array('d', [column[i] for i in rows])
+            r = self._sorted[key] = rows, values
+            return r
+
+    def rows(self, key, lo=None, hi=None):
+        """Returns the rows with *lo* <= value <= *hi*. None means no
+        limit."""
+        rows, values = self._get_sorted(key)
+        i = 0 if lo is None else bisect_left(values, lo)
+        j = len(values) if hi is None else bisect_right(values, hi)
+        return rows[i:j]
+
+    def query(self, ranges):
+        """Returns the set of names within all *ranges*, a dict {key :
+        (lo, hi)}."""
+        r = None
+        # start with the most selective range
+        l = sorted((self.rows(key, lo, hi) for (key, (lo, hi)) \
+                    in ranges.items()), key=len)
+        for rows in l:
+            if r is None:
+                r = set(rows)
+            else:
+                r.intersection_update(rows)
+            if not r:
+                break
+        if r is None:
+            return set(self.names)
+        names = self.names
+        return set(names[i] for i in r)
+
+
+_number = r'([-+]?[0-9]*\.?[0-9]+(?:[eE][-+]?[0-9]+)?)(%?)'
+_clause_re = re.compile(
+    r'^\s*([a-z_]+)\s*(?:(<=?|>=?)\s*%s|%s\s*(?:-|\.\.)\s*%s)\s*$' % \
+    (_number, _number, _number))
+
+def parse_ranges(s):
+    """Parses a description of property ranges like "thickness
+    12-14%, camber < 2%" into a dict {key : (lo, hi)}. Keys may be
+    abbreviated. Raises ValueError for invalid input."""
+    r = {}
+    for clause in s.lower().split(','):
+        if not clause.strip():
+            continue
+        m = _clause_re.match(clause)
+        if m is None:
+            raise ValueError("Invalid range: %r" % clause.strip())
+        name, op, v, p, v1, p1, v2, p2 = m.groups()
+        keys = [key for key in PROPERTIES if key.startswith(name)]
+        # "thick" means thickness, not thickness_pos
+        keys = [key for key in keys if not any(
+            key.startswith(other) and key != other for other in keys)]
+        if len(keys) != 1:
+            raise ValueError("Unknown property: %r" % name)
+        def value(v, percent):
+            return float(v)/100 if percent else float(v)
+        if op:
+            if op.startswith('<'):
+                lo, hi = None, value(v, p)
+            else:
+                lo, hi = value(v, p), None
+        else:
+            # "12-14%" means both values are percent
+            lo, hi = value(v1, p1 or p2), value(v2, p2 or p1)
+        r[keys[0]] = lo, hi
+    return r
+
+
+
+def test_00():
+    "properties"
+    from .matching import _load_foils
+    foils = _load_foils()
+    xv, yv = foils['n0012-il.dat']
+    p = geometric_properties(xv, yv)
+    assert abs(p['thickness']-0.12) < 0.002
+    assert abs(p['thickness_pos']-0.3) < 0.02
+    assert abs(p['camber']) < 0.001
+    # exact value is 1.1019*0.12**2
+    assert abs(p['le_radius']-0.0159) < 0.002
+    assert p['npoints'] == len(xv)
+    xv, yv = foils['clarky-il.dat']
+    p = geometric_properties(xv, yv)
+    assert abs(p['thickness']-0.117) < 0.003
+    assert 0.03 < p['camber'] < 0.045
+
+
+def test_01():
+    "range queries"
+    from .matching import _load_foils
+    foils = _load_foils(400)
+    index = PropertyIndex(foils)
+    ranges = parse_ranges('thick 10-12%, camber < 2%')
+    assert ranges == dict(thickness=(0.1, 0.12), camber=(None, 0.02))
+    r = index.query(ranges)
+    ref = set()
+    for name, (xv, yv) in foils.items():
+        p = geometric_properties(xv, yv)
+        if 0.1 <= p['thickness'] <= 0.12 and p['camber'] <= 0.02:
+            ref.add(name)
+    assert r == ref and len(r) > 0
+    assert index.query({}) == set(foils.keys())
+    assert parse_ranges('npoints > 100') == dict(npoints=(100, None))
+    assert parse_ranges('le_radius 0.01..0.02') == dict(le_radius=(0.01, 0.02))
+    for s in ('thickness', 'foo < 1', 'thickness 1-'):
+        try:
+            parse_ranges(s)
+        except ValueError:
+            pass
+        else:
+            assert False
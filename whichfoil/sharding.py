@@ -0,0 +1,129 @@
+# -*- coding: latin-1 -*-
+
+"""
+Sharded matching for very large catalogs.
+
+The signature vectors are split into contiguous shards. Each shard is
+held by a worker process, which builds its own k-d tree once and then
+answers queries sent through a pipe. A query is sent to all workers
+before any answer is read, so that the shards are searched in
+parallel. Box queries are concatenated, nearest neighbour queries are
+merged from the partial top-k lists.
+
+ShardedEngine has the interface of MatchEngine and can be used
+wherever an engine is expected:
+
+    engine = ShardedEngine(open_catalog(), processes=4)
+    print(engine.rank([(0.09, -0.04), (0.09, -0.03), (0.05, -0.02)], 10))
+    engine.close()
+"""
+
+import multiprocessing
+from heapq import merge
+from itertools import islice
+
+from .matching import MatchEngine, KDTree, STATIONS
+
+
+def _shard_worker(conn, columns, indices, offset):
+    # Runs in the worker process. *columns* hold the shard only,
+    # *offset* is the index of its first point in the full columns.
+    tree = KDTree(columns, indices)
+    while True:
+        request = conn.recv()
+        if request is None:
+            break
+        what, args = request
+        if what == 'box':
+            r = [i+offset for i in tree.query_box(*args)]
+        elif what == 'knn':
+            r = [(d, i+offset) for (d, i) in tree.query_knn(*args)]
+        conn.send(r)
+    conn.close()
+
+
+class ShardedTree:
+    """Distributes the points *indices* of *columns* over *processes*
+    worker processes. Provides query_box and query_knn as KDTree."""
+    def __init__(self, columns, indices, processes=None):
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        n = len(columns[0]) if columns else 0
+        size = max(1, -(-n//processes))
+        self.workers = []
+        indices = sorted(indices)
+        start = 0
+        for a in range(0, n, size):
+            b = min(n, a+size)
+            shard = [column[a:b] for column in columns]
+            stop = start
+            while stop < len(indices) and indices[stop] < b:
+                stop += 1
+            local = [i-a for i in indices[start:stop]]
+            start = stop
+            conn, child = multiprocessing.Pipe()
+            process = multiprocessing.Process(
+                target=_shard_worker, args=(child, shard, local, a))
+            process.daemon = True
+            process.start()
+            child.close()
+            self.workers.append((process, conn))
+
+    def _ask(self, what, *args):
+        for process, conn in self.workers:
+            conn.send((what, args))
+        return [conn.recv() for (process, conn) in self.workers]
+
+    def query_box(self, lo, hi):
+        r = []
+        for partial in self._ask('box', lo, hi):
+            r.extend(partial)
+        return r
+
+    def query_knn(self, p, k):
+        return list(islice(merge(*self._ask('knn', p, k)), k))
+
+    def close(self):
+        for process, conn in self.workers:
+            try:
+                conn.send(None)
+                conn.close()
+            except (OSError, EOFError):
+                pass
+        for process, conn in self.workers:
+            process.join()
+        self.workers = []
+
+
+class ShardedEngine(MatchEngine):
+    """MatchEngine which searches the catalog in *processes* worker
+    processes. The workers run until close() is called."""
+    def __init__(self, catalog, stations=STATIONS, processes=None):
+        self.processes = processes
+        MatchEngine.__init__(self, catalog, stations)
+
+    def _mk_tree(self, columns, valid):
+        return ShardedTree(columns, valid, self.processes)
+
+    def close(self):
+        self.tree.close()
+
+
+
+def test_00():
+    "sharded engine"
+    from .matching import _load_foils
+    foils = _load_foils(400)
+    engine = MatchEngine(foils)
+    sharded = ShardedEngine(foils, processes=3)
+    try:
+        assert len(sharded.tree.workers) == 3
+        sliders = [(0.0885, -0.0361), (0.0940, -0.0351), (0.0513, -0.0224)]
+        for delta in (0.0, 0.01, 0.05):
+            assert sharded.match(sliders, delta) == engine.match(sliders, delta)
+        r1 = engine.rank(sliders, 20)
+        r2 = sharded.rank(sliders, 20)
+        assert [name for (name, score) in r1] == [name for (name, score) in r2]
+        assert [score for (name, score) in r1] == [score for (name, score) in r2]
+    finally:
+        sharded.close()
@@ -0,0 +1,207 @@
+# -*- coding: latin-1 -*-
+
+"""
+Tiled image pyramid for drawing large scans.
+
+Level 0 is the image itself, each further level halves its size. The
+levels are computed in a background thread. Each level is cut into
+square tiles, which are converted to bitmaps only when they become
+visible. A bounded number of tile bitmaps is kept, so that memory use
+and paint time depend on the window size rather than on the image
+size.
+"""
+
+import sys
+import threading
+from collections import OrderedDict
+from math import log, floor
+
+import wx
+
+from .imagedata import open_stream
+
+
+if wx.VERSION[0] <= 3:
+    image_from_data = wx.ImageFromData
+    empty_image = wx.EmptyImage
+    def image2bitmap(image):
+        return image.ConvertToBitmap()
+else:
+    image_from_data = wx.Image
+    empty_image = wx.Image
+    image2bitmap = wx.Bitmap
+
+
+def decode_image(data, callback, maxsize=1024):
+    """Decodes the image file contents *data*, ImageData or bytes.
+    Meant to run in a worker thread.
+
+    The result is passed as callback(data, image, size, final) in the
+    GUI thread. Images larger than *maxsize* are also passed as a
+    preview of at most *maxsize* pixels, with final=False and the size
+    of the full image. The preview can be drawn when zoomed out, while
+    the levels of the full image are still being computed.
+
+    JPEG files are decoded at a reduced scale for the preview, which
+    is much faster, so it is available long before the full image.
+    Other formats can not be decoded partially. For them the preview
+    is a fast, unfiltered downscaling of the full image and comes
+    right before it.
+    """
+    preview = False
+    if data[:2] == b'\xff\xd8' and hasattr(wx, 'IMAGE_OPTION_MAX_WIDTH'):
+        im = empty_image()
+        im.SetOption(wx.IMAGE_OPTION_MAX_WIDTH, maxsize)
+        im.SetOption(wx.IMAGE_OPTION_MAX_HEIGHT, maxsize)
+        if im.LoadFile(open_stream(data), wx.BITMAP_TYPE_JPEG):
+            size = (im.GetOptionInt(wx.IMAGE_OPTION_ORIGINAL_WIDTH),
+                    im.GetOptionInt(wx.IMAGE_OPTION_ORIGINAL_HEIGHT))
+            if size[0] > im.GetWidth():
+                wx.CallAfter(callback, data, im, size, False)
+                preview = True
+    im = wx.ImageFromStream(open_stream(data))
+    size = w, h = tuple(im.GetSize())
+    if not preview and im.IsOk() and max(w, h) > maxsize:
+        f = float(maxsize)/max(w, h)
+        small = im.Scale(max(1, int(w*f)), max(1, int(h*f)),
+                         wx.IMAGE_QUALITY_NORMAL)
+        wx.CallAfter(callback, data, small, size, False)
+    wx.CallAfter(callback, data, im, size, True)
+
+
+def choose_level(zoom, nlevels):
+    """Returns the pyramid level for drawing at *zoom*: the smallest
+    level which still has at least one pixel per screen pixel."""
+    if zoom >= 1 or nlevels <= 1:
+        return 0
+    level = int(floor(log(1.0/zoom, 2)+1e-9))
+    return max(0, min(level, nlevels-1))
+
+
+def tile_range(x0, y0, x1, y1, width, height, tilesize):
+    """Returns the tile indices (i, j) covering the rectangle (x0, y0)
+    - (x1, y1) of a level with size *width* x *height*."""
+    i0 = max(0, int(floor(x0/tilesize)))
+    j0 = max(0, int(floor(y0/tilesize)))
+    i1 = min((width-1)//tilesize, int(floor(x1/tilesize)))
+    j1 = min((height-1)//tilesize, int(floor(y1/tilesize)))
+    return [(i, j) for j in range(j0, j1+1) for i in range(i0, i1+1)]
+
+
+class TilePyramid:
+    """Pyramid of *image*, a wx.Image.
+
+    *table* is an optional translation table (see view.hue_table)
+    which is applied to each tile when it is converted to a bitmap.
+    *callback* is called in the GUI thread whenever a new level is
+    available. If *image* is a downscaled preview, *size* is the size
+    of the full image; tiles are positioned in its coordinates.
+
+    *preview* is an optional downscaled copy of *image*. It is drawn
+    instead of *image* as long as the level needed for the zoom has
+    not been computed, provided it has enough resolution.
+    """
+    tilesize = 512
+    maxtiles = 64 # number of tile bitmaps kept
+    def __init__(self, image, table=None, callback=None, size=None,
+                 preview=None):
+        self.size = tuple(size or image.GetSize())
+        self.levels = [image]
+        self.preview = preview
+        self.table = table
+        self.callback = callback
+        self._bitmaps = OrderedDict()
+        self._cancelled = False
+        self._thread = threading.Thread(target=self._build)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _build(self):
+        # Runs in the background thread. Each level is computed from
+        # the previous one.
+        image = self.levels[0]
+        w, h = image.GetSize()
+        while max(w, h) > self.tilesize and not self._cancelled:
+            w = max(1, w//2)
+            h = max(1, h//2)
+            image = image.Scale(w, h, wx.IMAGE_QUALITY_BOX_AVERAGE)
+            self.levels.append(image)
+            if self.callback is not None and not self._cancelled:
+                wx.CallAfter(self.callback)
+
+    def cancel(self):
+        """Stops building the levels, e.g. when the image is replaced"""
+        self._cancelled = True
+        self._bitmaps.clear()
+
+    def set_table(self, table):
+        # The bitmaps are created again with the new table. The levels
+        # are not affected.
+        self.table = table
+        self._bitmaps.clear()
+
+    def get_bitmap(self, level, i, j):
+        key = level, i, j
+        bitmaps = self._bitmaps
+        try:
+            bmp = bitmaps.pop(key)
+        except KeyError:
+            if level == 'preview':
+                image = self.preview
+            else:
+                image = self.levels[level]
+            w, h = image.GetSize()
+            s = self.tilesize
+            rect = wx.Rect(i*s, j*s, min(s, w-i*s), min(s, h-j*s))
+            tile = image.GetSubImage(rect)
+            if self.table is not None:
+                data = bytes(tile.GetData()).translate(self.table)
+                tile = image_from_data(rect.width, rect.height, data)
+            bmp = image2bitmap(tile)
+            if len(bitmaps) >= self.maxtiles:
+                bitmaps.popitem(last=False)
+        bitmaps[key] = bmp
+        return bmp
+
+    def visible_tiles(self, x0, y0, x1, y1, zoom):
+        """Yields (x, y, w, h, bitmap) for the tiles covering the image
+        rectangle (x0, y0) - (x1, y1) when drawn at *zoom*. The
+        rectangle x, y, w, h is in image coordinates."""
+        # zoom relative to level 0, which may be a preview
+        f0 = float(self.size[0])/self.levels[0].GetWidth()
+        levels = self.levels
+        level = choose_level(zoom*f0, sys.maxsize)
+        preview = self.preview
+        if level < len(levels):
+            image = levels[level]
+        elif preview is not None and \
+             preview.GetWidth() >= zoom*self.size[0]:
+            level = 'preview'
+            image = preview
+        else:
+            level = len(levels)-1
+            image = levels[level]
+        width, height = image.GetSize()
+        # levels are rounded down, so the factor is not exactly 2**level
+        fx = float(self.size[0])/width
+        fy = float(self.size[1])/height
+        s = self.tilesize
+        for i, j in tile_range(x0/fx, y0/fy, x1/fx, y1/fy, width, height, s):
+            bmp = self.get_bitmap(level, i, j)
+            w, h = bmp.GetSize()
+            yield i*s*fx, j*s*fy, w*fx, h*fy, bmp
+
+
+
+def test_00():
+    "levels and tiles"
+    assert choose_level(2.0, 5) == 0
+    assert choose_level(1.0, 5) == 0
+    assert choose_level(0.5, 5) == 1
+    assert choose_level(0.3, 5) == 1
+    assert choose_level(0.25, 5) == 2
+    assert choose_level(0.01, 5) == 4
+    assert tile_range(0, 0, 100, 100, 1000, 1000, 512) == [(0, 0)]
+    assert tile_range(-50, 500, 600, 520, 1000, 1000, 512) == \
+        [(0, 0), (1, 0), (0, 1), (1, 1)]
+    assert tile_range(2000, 0, 3000, 10, 1000, 1000, 512) == []
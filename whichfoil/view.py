@@ -2,18 +2,19 @@
 
 from __future__ import absolute_import
 import sys
+import threading
 import wx
+import wx.lib.newevent
 import math
 from math import sin, cos, pi, sqrt
-try:
-    from StringIO import StringIO ## for Python 2
-except ImportError:
-    from io import BytesIO as StringIO ## for Python 3
 
 
 from . import geometry
 from .geometry import create_matrix
 from .viewbase import ViewBase
+from .airfoil import Airfoil
+from .tiles import TilePyramid, decode_image
+from .contour import extract_contour
 
 
 
@@ -27,6 +28,29 @@ else:
     image2bitmap = wx.Bitmap
     
 
+# Posted by the canvas while a slider is dragged and when it is
+# released. The attribute *sliders* holds all slider values including
+# the dragged one.
+SlidersEvent, EVT_SLIDERS = wx.lib.newevent.NewEvent()
+
+
+def hue_table(hue):
+    """Returns the translation table for bytes.translate which applies
+    *hue* to the channel values.
+
+    Values above 0.5 blend the image with white, smaller values with
+    black, as if a translucent rectangle was drawn over it. The caller
+    skips hue 0.5, which means no change.
+    """
+    if hue > 0.5:
+        alpha = 500*hue-255
+        color = 255 # white
+    else:
+        alpha = 255-500*hue
+        color = 0 # black
+    w = max(0.0, min(alpha, 255))/255.0
+    return bytes(bytearray(int(v+(color-v)*w+0.5) for v in range(256)))
+
                     
 def overridable_property(name, doc = None):
     setter_name = 'set_' + name
@@ -49,17 +73,21 @@ class Canvas(wx.ScrolledWindow, ViewBase):
     transient = overridable_property('transient', \
         'position of transient item in image coordinates or None')
     _transient = None
-    bmp = None
+    tiles = None # TilePyramid of the image as displayed
+    image = None
     _current = None
+
+    _size = None
+    def get_image_size(self):
+        """Returns the size (w, h) of the image or None. The size is
+        known as soon as a preview has been decoded."""
+        return self._size
+
     def update_scroll(self):
         if self.model is None:
             return
         m = self.get_image2window()
-        bmp = self.bmp
-        if bmp is None:
-            w = h = 100
-        else:
-            w, h = bmp.Size
+        w, h = self.get_image_size() or (100, 100)
         xl = []
         yl = []
         for p in [(0, 0), (0, h), (w, h), (w, 0)]:
@@ -102,43 +130,108 @@ class Canvas(wx.ScrolledWindow, ViewBase):
     def model_added(self, model):
         self.bmp_changed(model, None)
 
+    _decoded = None # (bmp, {mirror : image})
+    def get_image(self):
+        # Returns the image of the model, mirrored if needed, or None
+        # if it has not been decoded yet. Both orientations are kept.
+        model = self.model
+        bmp = model.bmp
+        if self._decoded is None or self._decoded[0] is not bmp:
+            return None
+        images = self._decoded[1]
+        mirror = bool(model.mirror)
+        if not mirror in images:
+            images[mirror] = images[not mirror].Mirror()
+        return images[mirror]
+
+    # Images are decoded in a worker thread, see decode_image. A
+    # preview is shown until the full image is available.
+    _loading = None # bmp which is being decoded or could not be decoded
+    _preview = None # (bmp, image, size), kept for the pyramid
+    def start_decoding(self, bmp):
+        if self._loading is bmp:
+            return
+        self._loading = bmp
+        thread = threading.Thread(target=decode_image,
+                                  args=(bmp, self.image_decoded))
+        thread.daemon = True
+        thread.start()
+
+    def image_decoded(self, bmp, im, size, final):
+        # Called in the GUI thread by decode_image
+        if not self or self.model is None or self.model.bmp is not bmp:
+            return # destroyed or image replaced
+        if final:
+            if not im.IsOk():
+                # Not an image. The canvas stays empty and pending
+                # callbacks are dropped. _loading is kept, so that
+                # the data is not decoded again.
+                self._preview = None
+                self._loaded_callbacks = []
+                self.update_bmp()
+                return
+            self._loading = None
+            self._decoded = bmp, {False : im}
+        else:
+            self._preview = bmp, im, size
+        self.update_bmp()
+        callbacks = self._loaded_callbacks
+        self._loaded_callbacks = []
+        for callback in callbacks:
+            callback()
+
+    _loaded_callbacks = ()
+    def call_when_loaded(self, callback):
+        """Calls *callback* as soon as the size of the current image is
+        known, i.e. when the preview or the image has been decoded."""
+        if self._size is not None:
+            callback()
+        else:
+            self._loaded_callbacks = list(self._loaded_callbacks)+[callback]
+
+    def get_table(self):
+        # The hue is applied to the RGB data of each tile by a lookup
+        # table. This is much faster than blending through a device
+        # context.
+        hue = self.model.hue
+        if hue == 0.5:
+            return None
+        assert hue>=0
+        assert hue<=1
+        return hue_table(hue)
+
     def update_bmp(self):
         model = self.model
         bmp = model.bmp
-        hue = model.hue
-        if bmp is None:
-            self.bmp = None
-        else:            
-            f = StringIO(bmp)
-            im = wx.ImageFromStream(f)
+        if self.tiles is not None:
+            self.tiles.cancel()
+        self.tiles = None
+        # the image as displayed but without hue, used for fitting
+        self.image = None
+        self._size = None
+        preview = self._preview
+        if preview is not None and preview[0] is bmp:
+            preview = preview[1]
             if model.mirror:
-                im = im.Mirror()
-
-            if hue != 0.5:
-                assert hue>=0
-                assert hue<=1
-                w, h = im.GetSize()
-                bmp2 = create_bitmap(w, h)
-                dc = wx.MemoryDC()
-                dc.SelectObject(bmp2)
-                
-                dc.DrawBitmap(image2bitmap(im), 0, 0)
-                if model.hue>0.5:
-                    alpha = 500*hue-255
-                    color = wx.Colour(255, 255, 255, alpha) # white
-                else:
-                    alpha = 255-500*hue
-                    color = wx.Colour(0, 0, 0, alpha) # black
-                brush = wx.Brush(color)
-                dc.SetBrush(brush)
-                dc.SetPen(wx.TRANSPARENT_PEN)
-                dc.DrawRectangle(0, 0, w, h)
-                dc.SelectObject(wx.NullBitmap)
-                self.bmp = bmp2
-            else:
-                #print ("update bmp. brightness=", brightness, "transparancy=", transparency)
-                #im = im.AdjustChannels(brightness, 1, 1, transparency)
-                self.bmp = image2bitmap(im)
+                preview = preview.Mirror()
+        else:
+            preview = self._preview = None
+        if bmp is None:
+            self._decoded = None
+        elif self.get_image() is not None:
+            im = self.image = self.get_image()
+            self._size = tuple(im.GetSize())
+            # The pyramid levels are computed in the background. Until
+            # they are ready, the preview or finer levels are drawn.
+            self.tiles = TilePyramid(im, self.get_table(), self.tiles_ready,
+                                     preview=preview)
+        else:
+            if preview is not None:
+                self._size = self._preview[2]
+                self.tiles = TilePyramid(preview, self.get_table(),
+                                         self.tiles_ready, self._size)
+            self.start_decoding(bmp)
+        self.update_contour()
                 
         self.update_scroll()
         self.Refresh()
@@ -146,14 +239,49 @@ class Canvas(wx.ScrolledWindow, ViewBase):
     def bmp_changed(self, model, old):
         self.update_bmp()
 
+    def tiles_ready(self):
+        # called when a pyramid level has been computed
+        if self: # not destroyed
+            self.Refresh()
+
+    # The outline detected in the image, in image coordinates. It is
+    # computed from the image without hue, so only a new image or
+    # mirroring requires to detect it again.
+    show_contour = False
+    contour = None
+    contour_size = 512 # size of the downscaled image used for detection
+    def update_contour(self):
+        im = self.image
+        if not self.show_contour or im is None:
+            self.contour = None
+            return
+        w, h = im.GetSize()
+        f = min(1.0, float(self.contour_size)/max(w, h))
+        sw = max(1, int(w*f))
+        sh = max(1, int(h*f))
+        if (sw, sh) != (w, h):
+            im = im.Scale(sw, sh, wx.IMAGE_QUALITY_BOX_AVERAGE)
+        gray = bytes(im.ConvertToGreyscale().GetData()[0::3])
+        fx = float(w)/sw
+        fy = float(h)/sh
+        self.contour = [(x*fx, y*fy) for (x, y) in \
+                        extract_contour(gray, sw, sh)]
+
+    def set_show_contour(self, value):
+        self.show_contour = value
+        self.update_contour()
+        self.Refresh()
+
     def hue_changed(self, model, old):
-        self.update_bmp()
+        if self.tiles is not None:
+            self.tiles.set_table(self.get_table())
+        self.Refresh()
 
     def transparency_changed(self, model, old):
         self.update_bmp()
         
     def mirror_changed(self, model, old):
-        self.bmp_changed(model, None)
+        self.update_bmp()
 
     def alpha_changed(self, model, old):
         self.update_scroll()
@@ -167,6 +295,14 @@ class Canvas(wx.ScrolledWindow, ViewBase):
         self.update_scroll()
         self.Refresh()
             
+    def attributes_changed(self, model, old):
+        # Several attributes were set at once. Attributes which only
+        # need a redraw share a single Refresh.
+        for name, value in old.items():
+            if name not in ('p1', 'p2', 'yfactor'):
+                getattr(self, name+'_changed', self.model_changed)(model, value)
+        self.Refresh()
+
     def p1_changed(self, model, old):
         self.Refresh()
     
@@ -179,6 +315,12 @@ class Canvas(wx.ScrolledWindow, ViewBase):
     def airfoil_changed(self, model, old):
         self.Refresh()
 
+    def stations_changed(self, model, old):
+        self.Refresh()
+
+    def outline_changed(self, model, old):
+        self.Refresh()
+
     def xshift_changed(self, model, old):
         self.Refresh()
 
@@ -194,11 +336,7 @@ class Canvas(wx.ScrolledWindow, ViewBase):
         return 0.5*(virtual-window)-scroll
 
     def get_image2window(self):
-        bmp = self.bmp
-        if bmp is None:
-            w = h = 100
-        else:
-            w, h = bmp.Size
+        w, h = self.get_image_size() or (100, 100)
         #alpha = math.atan2((p1[1]-p2[1]), p2[0]-p1[0])
         alpha = self.model.alpha*pi/180.0
         # Alpha >0 bedeutet eine Drehung des Bildes im Uhrzeigersinn!
@@ -223,11 +361,7 @@ class Canvas(wx.ScrolledWindow, ViewBase):
         return r
 
     def get_image2virtual(self):
-        bmp = self.bmp
-        if bmp is None:
-            w = h = 100
-        else:
-            w, h = bmp.Size
+        w, h = self.get_image_size() or (100, 100)
         alpha = self.model.alpha
         zoom = self.model.zoom
 
@@ -285,6 +419,55 @@ class Canvas(wx.ScrolledWindow, ViewBase):
         gc.DrawLines([p+(-e, +e), p+(+e, -e)])
         
             
+    def _draw_mark(self, gc, p):
+        e = 7
+        gc.DrawLines([p-(e, 0), p+(e, 0)])
+
+    _foil = None
+    def get_airfoil(self):
+        # Returns the current airfoil as airfoil.Airfoil. The object is
+        # kept until the airfoil changes.
+        airfoil = self.model.airfoil
+        if self._foil is None or self._foil[0] is not airfoil:
+            name, (xv, yv) = airfoil
+            self._foil = airfoil, Airfoil(xv, yv)
+        return self._foil[1]
+            
+    _background = None # (key, bitmap)
+    def get_background(self, image2window):
+        # Returns the image as drawn into the window. Resampling a
+        # rotated or zoomed image is expensive, so the result is kept
+        # until the view or the image changes. Moving handles only
+        # redraws the overlay.
+        model = self.model
+        tiles = self.tiles
+        key = (model.alpha, model.zoom, tuple(model.focus), tuple(self.Size),
+               self.GetScrollPos(wx.HORIZONTAL),
+               self.GetScrollPos(wx.VERTICAL),
+               tiles, tiles.table, len(tiles.levels))
+        if self._background is not None and self._background[0] == key:
+            return self._background[1]
+        w, h = self.Size
+        bmp = create_bitmap(max(1, w), max(1, h))
+        dc = wx.MemoryDC(bmp)
+        dc.SetBackground(wx.Brush(self.GetBackgroundColour()))
+        dc.Clear()
+        gc = wx.GraphicsContext.Create(dc)
+        # only the tiles within the window are drawn
+        inv = image2window.Inverted()
+        corners = [inv(wx.Point2D(x, y)) for (x, y) in \
+                   ((0, 0), (w, 0), (0, h), (w, h))]
+        xl = [p[0] for p in corners]
+        yl = [p[1] for p in corners]
+        gc.ConcatTransform(image2window)
+        for x, y, tw, th, tile in tiles.visible_tiles(
+                min(xl), min(yl), max(xl), max(yl), model.zoom):
+            gc.DrawBitmap(tile, x, y, tw, th)
+        del gc # flushes the drawing
+        dc.SelectObject(wx.NullBitmap)
+        self._background = key, bmp
+        return bmp
+
     _radius = 18
     def on_paint(self, event):
         buffer = wx.EmptyBitmap(*self.Size)
@@ -299,12 +482,9 @@ class Canvas(wx.ScrolledWindow, ViewBase):
         zoom = model.zoom
         yfactor = model.yfactor
 
-        bmp = self.bmp
-        if bmp:
-            gc.PushState()
-            gc.ConcatTransform(image2window)
-            gc.DrawBitmap(bmp, -0, -0, bmp.Width, bmp.Height)
-            gc.PopState()
+        if self.tiles is not None:
+            bg = self.get_background(image2window)
+            gc.DrawBitmap(bg, 0, 0, bg.Width, bg.Height)
 
         linewidth = 2.0
         pen = wx.Pen(colour="red", width=linewidth)        
@@ -325,7 +505,7 @@ class Canvas(wx.ScrolledWindow, ViewBase):
             gc.SetBrush(brush)
             
             gc.SetPen(pen)
-            if self._current in (6, 7):
+            if self._current >= len(model.sliders):
                 self._draw_edge_handle(gc, p_)
             else:
                 self._draw_sub_handle(gc, p_)                
@@ -347,14 +527,44 @@ class Canvas(wx.ScrolledWindow, ViewBase):
             gc.SetPen(pen)
             gc.StrokePath(path)        
 
+            # mark where the airfoil crosses the stations
+            lower, upper = self.get_airfoil().evaluate(model.stations)
+            for x, y1, y2 in zip(model.stations, lower, upper):
+                if y1 != y1: # nan, airfoil does not cover x
+                    continue
+                for y in y1, y2:
+                    p_ = profile2win(wx.Point2D(x, y*yfactor))
+                    self._draw_mark(gc, p_)
+
+        if self.contour:
+            pen = wx.Pen(colour="orange", width=linewidth)
+            gc.SetPen(pen)
+            points = [t(wx.Point2D(*p)) for p in self.contour]
+            gc.DrawLines(points+points[:1])
+
+        outline = list(model.outline)+list(self._trace or ())
+        if outline:
+            pen = wx.Pen(colour="blue", width=linewidth)
+            gc.SetPen(pen)
+            points = [t(wx.Point2D(*p)) for p in outline]
+            if len(points) > 1:
+                gc.DrawLines(points)
+            for p in points:
+                self._draw_sub_handle(gc, p)
+
         pen = wx.Pen(colour="red", width=linewidth)        
         gc.SetPen(pen)        
         for x, y in zip(self.xpositions, model.sliders):
             p = wx.Point2D(x, y)
             self._draw_sub_handle(gc, profile2win(p))                
                 
-    # x-part of position of sliders. Fixed.    
-    xpositions = (0.25, 0.25, 0.5, 0.5, 0.75, 0.75)
+    def get_xpositions(self):
+        # x-part of position of sliders. Each station has two sliders.
+        r = []
+        for x in self.model.stations:
+            r.extend((x, x))
+        return r
+    xpositions = property(get_xpositions)
     
     def set_transient(self, p):
         if p != self._transient:
@@ -369,6 +579,29 @@ class Canvas(wx.ScrolledWindow, ViewBase):
                 x, y = image2window.TransformPoint(*p)
                 self.RefreshRect((x-d, y-d, x+d, y+d))
                             
+    # In tracing mode, clicked or dragged points are added to the
+    # outline of the model.
+    tracing = False
+    _trace = None # outline points while dragging
+    def trace_event(self, event, p):
+        if event.LeftDown():
+            self._trace = [tuple(p)]
+        elif event.Dragging() and self._trace is not None:
+            m = self.get_image2window()
+            last = m(wx.Point2D(*self._trace[-1]))
+            if (m(p)-last).Length() >= 3:
+                self._trace.append(tuple(p))
+                self.Refresh()
+        elif event.LeftUp() and self._trace is not None:
+            trace = self._trace
+            self._trace = None
+            self.model.outline = tuple(self.model.outline)+tuple(trace)
+
+    def get_outline(self):
+        """Returns the outline of the model in profile coordinates"""
+        m = self.get_profile2image().Inverted()
+        return [tuple(m(wx.Point2D(*p))) for p in self.model.outline]
+
     _dragstart = None # in image coordinates
     def mouse_event(self, event):
         image2window = self.get_image2window()
@@ -403,7 +636,11 @@ class Canvas(wx.ScrolledWindow, ViewBase):
                 self._current = None
                 self.SetCursor(wx.StockCursor(wx.CURSOR_DEFAULT))
 
-        if event.LeftDown() and self._current is not None:
+        if self.tracing and self._current is None and \
+           (event.LeftDown() or event.LeftUp() or event.Dragging()):
+            self.trace_event(event, p)
+
+        elif event.LeftDown() and self._current is not None:
             self._dragstart = p
             points = hvec+[p1, p2]
             self.transient = points[self._current]
@@ -412,25 +649,30 @@ class Canvas(wx.ScrolledWindow, ViewBase):
             points = hvec+[p1, p2]
             delta = p-self._dragstart
             t = points[self._current]+delta
-            if self._current<6:
+            if self._current<len(model.sliders):
                 m = profile2image.Inverted()
                 t__ = m(t)
                 t__[0] = self.xpositions[self._current]
                 t = profile2image(t__)
+                sliders = list(model.sliders)
+                sliders[self._current] = t__[1]
+                wx.PostEvent(self, SlidersEvent(sliders=tuple(sliders)))
             self.transient = t
             
         elif event.LeftUp():
             transient = self._transient
             if transient is not None:
                 i = self._current
-                if i in range(6):
+                n = len(model.sliders)
+                if i < n:
                     m = profile2image.Inverted()
                     sliders = list(model.sliders)
                     sliders[i] = m(transient)[1]
                     model.sliders = tuple(sliders)
-                elif i == 6:
+                    wx.PostEvent(self, SlidersEvent(sliders=model.sliders))
+                elif i == n:
                     model.p1 = tuple(transient)
-                elif i == 7:
+                elif i == n+1:
                     model.p2 = tuple(transient)
                 self.Refresh() # to remove the original 
             
@@ -516,3 +758,12 @@ def test_00():
     
 
 
+def test_01():
+    "hue table"
+    assert hue_table(0.51) == bytes(bytearray(range(256)))
+    table = hue_table(1.0)
+    assert table[255:] == b'\xff' and table[0] > 200
+    table = hue_table(0.0)
+    assert table[0:1] == b'\x00' and table[255] < 20
+    data = bytes(bytearray([0, 128, 255]))
+    assert data.translate(hue_table(0.75)) == bytes(bytearray([120, 188, 255]))